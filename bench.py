@@ -0,0 +1,219 @@
+# Replays a recording made with OMNICONTROL_RECORD_DIR through MyAppLayout's
+# pipeline without the Hugging Face Space, the Gemini API or a real desktop.
+#
+#   python bench.py recordings/my_run --loops 3
+import argparse
+import io
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import PIL.Image
+
+os.environ.setdefault("API_KEY", "replay")
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+os.environ.setdefault("KIVY_NO_CONSOLELOG", "1")
+if not os.environ.get("DISPLAY") and sys.platform.startswith("linux"):
+    os.environ.setdefault("SDL_VIDEODRIVER", "offscreen")
+
+
+class ReplayState:
+    def __init__(self, steps):
+        self.steps = steps
+        self.index = 0
+        self.images = [PIL.Image.open(io.BytesIO(step["image_data"])).convert("RGB") for step in steps]
+        self.lock = threading.Lock()
+
+    def current(self):
+        with self.lock:
+            return min(self.index, len(self.steps) - 1)
+
+    def advance(self):
+        with self.lock:
+            self.index += 1
+
+    def reset(self):
+        with self.lock:
+            self.index = 0
+
+
+class FakeParserHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    event_ids = itertools.count(1)
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path != "/gradio_api/call/process":
+            self._send(404, "text/plain", b"not found")
+            return
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        event_id = f"replay-{next(self.event_ids)}"
+        self._send(200, "application/json", json.dumps({"event_id": event_id}).encode())
+
+    def do_GET(self):
+        if not self.path.startswith("/gradio_api/call/process/"):
+            self._send(404, "text/plain", b"not found")
+            return
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        step = server.state.steps[server.state.current()]
+        parser_output = step["parser_output"]
+        result = [
+            {"path": f"/tmp/gradio/{step['image']}"},
+            parser_output["text"],
+            str(parser_output["coordinates"])
+        ]
+        body = (
+            "event: heartbeat\ndata: null\n\n"
+            f"event: complete\ndata: {json.dumps(result)}\n\n"
+        ).encode()
+        self._send(200, "text/event-stream", body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeParserServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, state, latency=0.0):
+        super().__init__(("127.0.0.1", 0), FakeParserHandler)
+        self.state = state
+        self.latency = latency
+
+    @property
+    def address(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+class FakeResponse:
+    chunk_size = 32
+
+    def __init__(self, text):
+        self.text = text
+
+    def __iter__(self):
+        # Streamed like the Gemini SDK: chunks with a .text each
+        for start in range(0, len(self.text), self.chunk_size):
+            yield FakeResponse(self.text[start:start + self.chunk_size])
+
+
+class FakeChat:
+    complete_response = json.dumps([{"reasoning": "End of recording.", "action_type": "complete"}])
+
+    def __init__(self, state, latency=0.0):
+        self.state = state
+        self.latency = latency
+        self.history = []
+
+    def send_message(self, prompt, stream=False):
+        if self.latency:
+            time.sleep(self.latency)
+        index = self.state.index
+        if index >= len(self.state.steps):
+            return FakeResponse(self.complete_response)
+        text = self.state.steps[index]["response"]
+        # The next screenshot shows the screen recorded after this action
+        self.state.advance()
+        return FakeResponse(text)
+
+
+def noop_pyautogui():
+    # Stand-in for pyautogui: actions do nothing, screenshots come from the recording.
+    # Installed before main is imported, so the replay state is attached afterwards.
+    module = types.ModuleType("pyautogui")
+    module.state = None
+    module.screenshot = lambda *args, **kwargs: module.state.images[module.state.current()].copy()
+    for name in ("moveTo", "click", "typewrite", "write", "scroll", "hotkey", "press"):
+        setattr(module, name, lambda *args, **kwargs: None)
+    return module
+
+
+def run_job(layout, objective, clock, timeout):
+    layout.user_input.text = objective
+    layout.start_job(None)
+    deadline = time.monotonic() + timeout
+    clock.tick()
+    while layout.processing:
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Replay did not finish within {timeout} seconds")
+        clock.tick()
+
+
+def print_report(records, wall_time, percentile):
+    steps = len(records)
+    print(f"steps: {steps}  wall: {wall_time:.2f}s  steps/sec: {steps / wall_time if wall_time else 0:.2f}")
+    stages = {}
+    for record in records:
+        for stage, seconds in record["stages"].items():
+            stages.setdefault(stage, []).append(seconds)
+    width = max([len("stage")] + [len(stage) for stage in stages]) + 2
+    print(f"{'stage':<{width}}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    for stage, seconds in stages.items():
+        print(
+            f"{stage:<{width}}{sum(seconds) / len(seconds) * 1000:>10.1f}"
+            f"{percentile(seconds, 0.5) * 1000:>10.1f}{percentile(seconds, 0.95) * 1000:>10.1f}"
+        )
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description="Replay a recorded OmniControl run as a benchmark.")
+    argument_parser.add_argument("recording", help="directory written with OMNICONTROL_RECORD_DIR")
+    argument_parser.add_argument("--loops", type=int, default=1, help="times to replay the recording")
+    argument_parser.add_argument("--parser-latency", type=float, default=0.0, help="simulated parser seconds per request")
+    argument_parser.add_argument("--model-latency", type=float, default=0.0, help="simulated model seconds per turn")
+    argument_parser.add_argument("--timeout", type=float, default=600.0, help="seconds allowed per replay")
+    argument_parser.add_argument("--json", help="write the step records to this JSONL file")
+    args = argument_parser.parse_args()
+
+    executor = sys.modules["pyautogui"] = noop_pyautogui()
+    import main as app
+    import omniparser
+    steps = app.load_recording(args.recording)
+    if not steps:
+        argument_parser.error(f"No recorded steps in {args.recording}")
+    state = executor.state = ReplayState(steps)
+
+    server = FakeParserServer(state, args.parser_latency)
+    server.start()
+    omniparser.parser_addresses = [server.address]
+    app.recording_dir = None
+    # Recorded outputs are full-screen parses; replay them as such
+    app.incremental_parsing = False
+    app.parser_cache_size = 0
+    app.trajectory_cache_path = None
+    app.metrics_path = args.json
+    app.metrics_prometheus_path = None
+
+    from kivy.clock import Clock
+    layout = app.MyAppLayout()
+    layout.chat = FakeChat(state, args.model_latency)
+
+    objective = steps[0]["objective"]
+    started = time.perf_counter()
+    for _ in range(args.loops):
+        state.reset()
+        run_job(layout, objective, Clock, args.timeout)
+    wall_time = time.perf_counter() - started
+
+    print_report(list(layout.metrics.records), wall_time, app.percentile)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
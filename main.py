@@ -1,84 +1,1458 @@
+import time
+# Startup timing: (phase, perf_counter) marks, reported in the event log
+startup_marks = [("start", time.perf_counter())]
+
+
+def startup_mark(phase):
+    startup_marks.append((phase, time.perf_counter()))
+
+
 import kivy
+from kivy.config import Config
+
+# Window configuration, applied before the window is created rather than resizing it afterwards
+Config.set('graphics', 'width', '1024')
+Config.set('graphics', 'height', '768')
+Config.set('graphics', 'position', 'custom')
+Config.set('graphics', 'left', '100')
+Config.set('graphics', 'top', '100')
+Config.set('graphics', 'borderless', '0')
+
 from kivy.app import App
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.textinput import TextInput
 from kivy.uix.button import Button
-from kivy.uix.scrollview import ScrollView
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleboxlayout import RecycleBoxLayout
 from kivy.uix.label import Label
 from kivy.core.window import Window
+from kivy.core.clipboard import Clipboard
+from kivy.graphics.texture import Texture
 from kivy.uix.image import Image
 from kivy.clock import Clock
-from kivy.metrics import dp
-from kivy.properties import ObjectProperty
-import pyautogui
+from kivy.metrics import dp, sp
+startup_mark("kivy")
+import importlib
 import os
+import sys
 import tempfile
 from datetime import datetime
 import base64
-from threading import Thread
-import requests
+from threading import Thread, Lock, Event, current_thread, main_thread
+from concurrent.futures import Future
+from queue import Queue, Empty
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 import json
+import re
 import ast
+import textwrap
 from dotenv import load_dotenv
-import google.generativeai as genai
+from omniparser import ParserPool, backoff_delay, build_parser_payload, parser_max_retries, percentile
 import PIL.Image
+from PIL import ImageChops, ImageDraw, ImageFont
 import typing_extensions
 from datetime import datetime
 from urllib.parse import quote
-import time
+import math
+import subprocess
 import urllib.request
+import io
+from array import array
+startup_mark("imports")
 
-# Load environment variables
-load_dotenv()
-genai.configure(api_key=os.environ["API_KEY"])
+# Heavy modules only needed once a job runs; imported on first use or by the warm-up
+lazy_import_times = {}
+
+
+class LazyModule:
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+        self.lock = Lock()
+
+    def load(self):
+        with self.lock:
+            if self.module is None:
+                start = time.perf_counter()
+                self.module = importlib.import_module(self.name)
+                lazy_import_times[self.name] = time.perf_counter() - start
+        return self.module
 
-# Window configuration
-Window.size = (1024, 768)
-Window.top = 100
-Window.left = 100
-Window.borderless = False
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
 
-# parser_address = "https://totob12-omniparser.hf.space/"
-parser_address = "https://microsoft-omniparser.hf.space"
 
-# class Action(typing_extensions.TypedDict):
-#     reasoning: str
-#     action_type: str
-#     action_element_id: str
-#     value: str
+pyautogui = LazyModule("pyautogui")
+genai = LazyModule("google.generativeai")
+
+# Load environment variables; the Gemini client is configured when the model is first built
+load_dotenv()
+
+# Event log: the last event_log_size events stay in memory, older ones are
+# dropped unless event_log_spill_path is set. Events include model responses and
+# typed text, so a spill file is created readable only by the user (0600).
+# The view refreshes at most event_log_refresh_rate times per second.
+# Appended files (the event spill and metrics_path) are rotated to "<path>.1"
+# once they pass log_max_bytes, so at most twice that is kept on disk.
+log_max_bytes = 5 * 1024 * 1024
+event_log_size = 2000
+event_log_spill_path = None
+event_log_refresh_rate = 4
+
+# Per-step stage timings: one JSON record per step is appended to metrics_path,
+# and metrics_prometheus_path holds p50/p95 over the last metrics_window steps.
+# The status bar shows only metrics_label_stages; the full set is in the event log.
+metrics_path = os.path.join(tempfile.gettempdir(), "omnicontrol_metrics.jsonl")
+metrics_prometheus_path = os.path.join(tempfile.gettempdir(), "omnicontrol_metrics.prom")
+metrics_window = 200
+metrics_label_stages = ("capture", "parser_queue", "parser_result", "model", "action", "total")
+
+# Screenshot store: captures and the images sent to the model are written to
+# screenshot_dir (None disables it), trimmed to the most recent screenshot_keep_count
+# images and screenshot_keep_bytes. Only their names and sizes are held in memory.
+# With screenshot_keep_on_error, the images of failed steps are moved to
+# screenshot_dir/kept instead of being evicted.
+# The preview shows the step's image downscaled to fit preview_max_size.
+screenshot_dir = os.path.join(tempfile.gettempdir(), "omnicontrol_screenshots")
+screenshot_keep_count = 40
+screenshot_keep_bytes = 100 * 1024 * 1024
+screenshot_keep_on_error = True
+preview_max_size = (960, 540)
+
+# Record each step's screenshot, parser output and model response for bench.py.
+# None disables recording.
+recording_dir = os.environ.get("OMNICONTROL_RECORD_DIR")
+
+# Objectives queued at startup, one per line ("#" starts a comment). The prompt
+# box queues a file the same way when given "@path".
+objectives_path = os.environ.get("OMNICONTROL_OBJECTIVES")
+
+# Chat context: the last chat_keep_screenshots turns are resent in full,
+# older turns as one-line records of the action and its outcome. With
+# chat_rolling_summary, records beyond chat_compact_turns are folded into a
+# single summary ahead of the next prompt.
+chat_keep_screenshots = 3
+chat_compact_turns = 20
+chat_rolling_summary = True
+
+# When False the app window stays visible during captures and its screen
+# rectangle (plus app_mask_margin for decorations) is blanked out instead.
+# Actions then only hide the window if they target a point inside it.
+capture_hide_app = False
+app_mask_margin = 32
+app_mask_color = (0, 0, 0)
+
+# Screenshot encoding sent to the parser: "PNG", "JPEG" or "WEBP".
+# capture_max_size downscales the upload to fit (width, height); None keeps full resolution.
+capture_format = "PNG"
+capture_quality = 85
+capture_max_size = None
+
+# Capture scope: "screen" grabs the whole desktop, "region" only capture_region
+# (left, top, right, bottom in screen pixels) and "window" the focused window, found
+# with xdotool on X11. Parsing and element boxes are relative to the captured area
+# and offset back to screen pixels for actions.
+capture_scope = "screen"
+capture_region = None
+
+capture_mime_types = {
+    "PNG": "image/png",
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
+}
+
+# Screen fingerprints: grayscale thumbnails compared cell by cell.
+# Two cells match when their gray levels differ by at most fingerprint_tolerance.
+fingerprint_size = (64, 36)
+fingerprint_tolerance = 8
+
+# Settle detection after actions: sample small frames every settle_interval and
+# continue once they stayed similar for settle_stable_time, or after settle_timeout.
+settle_interval = 0.1
+settle_stable_time = 0.4
+settle_timeout = 3.0
+settle_frame_size = (160, 90)
+settle_threshold = 0.998
+# Capture and parse the next screen as soon as it goes quiet after the last action,
+# instead of after the settle window; dropped if the screen changes again
+speculative_capture = True
+
+# Text entry: plain ASCII up to type_keystroke_max_chars is typed key by key;
+# longer or non-ASCII text is pasted through the clipboard, whose previous text
+# is put back type_paste_restore_delay seconds after the paste.
+type_keystroke_max_chars = 32
+type_keystroke_interval = 0.0
+type_focus_delay = 0.1
+type_paste_restore_delay = 0.15
+paste_hotkey = ("command", "v") if sys.platform == "darwin" else ("ctrl", "v")
+
+# Parser result cache: reuse parser output for screens whose fingerprint
+# similarity (fraction of matching cells) is at least parser_cache_threshold.
+parser_cache_size = 16
+parser_cache_ttl = 300  # seconds
+parser_cache_threshold = 0.999
+
+# Trajectory cache: steps of earlier jobs, keyed by normalized objective and the
+# screen fingerprint they started from, are replayed without the parser or model
+# when the screen matches with at least trajectory_cache_threshold similarity.
+# Entries whose replays diverge trajectory_max_failures times (and more often than
+# they succeed) are dropped. None disables the cache.
+# Entries include the text of "type" actions, passwords included, so the file lives
+# in the user's home directory and is only readable by them (0600).
+trajectory_cache_path = os.path.join(os.path.expanduser("~"), ".omnicontrol", "trajectories.json")
+trajectory_cache_size = 200
+trajectory_cache_threshold = 0.999
+trajectory_max_failures = 3
+
+# Incremental parsing: diff each capture against the last parsed one on a
+# diff_width-wide grayscale copy and only send the changed tiles to the parser.
+# Falls back to a full parse when more than diff_max_area of the screen changed,
+# or when there are more than diff_max_regions regions; the regions of one capture
+# are parsed concurrently.
+incremental_parsing = True
+diff_max_regions = 3
+diff_width = 960
+diff_grid = (32, 18)
+diff_tolerance = 24
+diff_max_area = 0.4
+diff_region_padding = 24  # pixels
+
+# Grid cell size (pixels) of the element table's spatial index
+element_index_cell = 64
+
+# Numbered element boxes drawn locally on the capture for the model and preview.
+annotation_style = {
+    "label_size": 16,
+    "box_color": (255, 0, 0),
+    "box_thickness": 2,
+    "label_color": (255, 255, 255),
+    "label_background": (255, 0, 0),
+}
+
+# Model payload: the annotated screenshot is downscaled to fit model_image_max_size
+# (None keeps full resolution) and encoded once as model_image_format, rather than
+# by the SDK (lossless WebP) each time the turn is resent. With model_focus_crop, a
+# close-up of the area that changed since the last step is sent as a second image.
+# Boxes narrower or shorter than model_min_element_size pixels are left out of the
+# element list, as are ones the parser reported with an empty label when
+# model_drop_unlabeled is set.
+model_image_max_size = (1536, 768)
+model_image_format = "JPEG"
+model_image_quality = 85
+model_focus_crop = False
+model_focus_max_size = (768, 768)
+model_focus_padding = 48  # pixels
+model_min_element_size = 4  # pixels
+model_drop_unlabeled = True
+
+# Batched actions: the model may return up to batch_max_actions actions per
+# turn. The batch stops early after an action marked "changes_screen" or when
+# the screen changed outside the acted-on element.
+batch_actions = True
+batch_max_actions = 5
+
+action_types = ["click", "right_click", "type", "scroll", "keybind", "complete"]
+pointer_action_types = ["click", "right_click", "type", "scroll"]
+# Step outcomes whose images screenshot_keep_on_error keeps
+failed_step_outcomes = ["replay_diverged", "parser_error", "action_error", "ai_error", "error"]
+
+single_action_policy = "You should only do one action at a time. Only respond with the next action to take."
+batch_action_policy = (
+    f"You may respond with an ordered list of up to {batch_max_actions} actions when none of them "
+    "depends on a screen you have not seen yet, for example when filling several fields of a form. "
+    "Add \"changes_screen\": true to an action that will change what is on screen (opening a menu, "
+    "submitting a form, navigating); it must be the last action in the list. "
+    "Only respond with \"complete\" on its own, after you have seen the result of your last actions "
+    "on the screen; a \"complete\" that follows other actions ends the list and you will be shown "
+    "the new screen first. "
+    "When in doubt, respond with a single action. For example:\n\n"
+    "[\n"
+    "    {\"reasoning\": \"Fill in the first name.\", \"action_type\": \"type\", \"action_element_id\": \"12\", \"value\": \"Ada\"},\n"
+    "    {\"reasoning\": \"Fill in the last name.\", \"action_type\": \"type\", \"action_element_id\": \"13\", \"value\": \"Lovelace\"},\n"
+    "    {\"reasoning\": \"Submit the form.\", \"action_type\": \"click\", \"action_element_id\": \"20\", \"changes_screen\": true}\n"
+    "]"
+)
+
+# Model responses are streamed; invalid ones are re-asked up to model_max_reasks
+# times. The executor waits at most model_stream_timeout seconds for the next action.
+model_max_reasks = 2
+model_stream_timeout = 60
+
+class Action(typing_extensions.TypedDict):
+    reasoning: str
+    action_type: str
+    action_element_id: str
+    value: str
+    changes_screen: bool
+
+def append_rotating(path, text, max_bytes=None):
+    max_bytes = log_max_bytes if max_bytes is None else max_bytes
+    try:
+        if max_bytes and os.path.getsize(path) >= max_bytes:
+            os.replace(path, path + ".1")
+    except OSError:
+        pass
+    with open(os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600), 'a', encoding='utf-8') as f:
+        f.write(text)
+
 
 class EventLog:
-    def __init__(self):
-        self.events = []
+    def __init__(self, max_events=None, spill_path=None):
+        self.events = deque(maxlen=max_events or event_log_size)
+        self.spill_path = event_log_spill_path if spill_path is None else spill_path
+        self.version = 0
+        self.lock = Lock()
 
     def add_event(self, event_type: str, message: str):
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        self.events.append(f"[{timestamp}] [{event_type}] {message}")
+        timestamp = datetime.now().strftime("%H:%M:%S.%f")[:-3]
+        with self.lock:
+            if len(self.events) == self.events.maxlen and self.spill_path:
+                try:
+                    append_rotating(self.spill_path, self.events[0] + "\n")
+                except OSError as e:
+                    # Logging must never fail the caller; stop spilling and say so once
+                    self.spill_path = None
+                    self.events.append(f"[{timestamp}] [LOG] Stopped writing old events to disk: {e}")
+            self.events.append(f"[{timestamp}] [{event_type}] {message}")
+            self.version += 1
+
+    def get_events(self):
+        with self.lock:
+            return list(self.events), self.version
 
     def get_formatted_log(self):
-        return "\n".join(self.events)
+        events, _ = self.get_events()
+        return "\n".join(events)
+
+
+class ActionStreamParser:
+    # Yields each top-level action object as soon as its closing brace arrives
+    def __init__(self):
+        self.buffer = ""
+        self.position = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.start = None
+        self.start_depth = 0
+
+    def feed(self, text):
+        self.buffer += text
+        actions = []
+        while self.position < len(self.buffer):
+            char = self.buffer[self.position]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                if char == "{" and self.start is None:
+                    self.start = self.position
+                    self.start_depth = self.depth
+                self.depth += 1
+            elif char in "}]":
+                self.depth -= 1
+                if char == "}" and self.start is not None and self.depth == self.start_depth:
+                    actions.append(json.loads(self.buffer[self.start:self.position + 1]))
+                    self.start = None
+            self.position += 1
+        return actions
+
+
+class ChatContext:
+    def __init__(self, keep_screenshots=None, compact_turns=None, rolling_summary=None):
+        self.keep_screenshots = chat_keep_screenshots if keep_screenshots is None else keep_screenshots
+        self.compact_turns = chat_compact_turns if compact_turns is None else compact_turns
+        self.rolling_summary = chat_rolling_summary if rolling_summary is None else rolling_summary
+        self.turns = []
+
+    def reset(self):
+        self.turns = []
+
+    def record_outcome(self, record):
+        if self.turns:
+            self.turns[-1]["record"] = record
+
+    def add_turn(self, text, response):
+        # A step taken without the model, e.g. replayed from the trajectory cache
+        self.turns.append({"images": [], "text": text, "response": response, "record": None})
+
+    def build_history(self):
+        history = []
+        summary = []
+        full_from = len(self.turns) - self.keep_screenshots
+        compact_from = full_from - self.compact_turns if self.rolling_summary else 0
+        for index, turn in enumerate(self.turns):
+            record = f"Step {index + 1}: {turn['record'] or 'no outcome recorded'}"
+            if index < compact_from:
+                summary.append(record)
+                continue
+            if index >= full_from:
+                parts = [*turn["images"], turn["text"]]
+            else:
+                parts = [record]
+                # Out of the window for good; don't hold its encoded images for the rest of the job
+                turn["images"] = []
+            if summary:
+                parts.insert(0, "Summary of earlier steps:\n" + "\n".join(summary))
+                summary = []
+            history.append({"role": "user", "parts": parts})
+            history.append({"role": "model", "parts": [turn["response"]]})
+        return history, summary
+
+    def send(self, chat, images, text, on_text=None):
+        history, summary = self.build_history()
+        prompt_text = text
+        if summary:
+            prompt_text = "Summary of earlier steps:\n" + "\n".join(summary) + "\n\n" + text
+        chat.history = history
+
+        # Input size of this request, to check that it stays flat over a job
+        parts = [*images, prompt_text]
+        stats = {"images": 0, "image_bytes": 0, "chars": 0}
+        for part in [part for content in history for part in content["parts"]] + parts:
+            if isinstance(part, str):
+                stats["chars"] += len(part)
+            else:
+                stats["images"] += 1
+                stats["image_bytes"] += len(part["data"])
 
+        if on_text is None:
+            response = chat.send_message(parts)
+            self.turns.append({"images": images, "text": text, "response": response.text, "record": None})
+            return response.text, stats
+
+        # Streamed: on_text sees every chunk and may stop the stream by raising;
+        # the turn is kept either way so a re-ask can refer to it
+        received = []
+        try:
+            for chunk in chat.send_message(parts, stream=True):
+                received.append(chunk.text)
+                on_text(chunk.text)
+        finally:
+            self.turns.append({"images": images, "text": text, "response": "".join(received), "record": None})
+        return "".join(received), stats
+
+
+class StepMetrics:
+    def __init__(self, step):
+        self.step = step
+        self.started_at = time.time()
+        self.stages = {}
+        self.sizes = {}
+        self.counts = {}
+        self.outcome = None
+        self.lock = Lock()
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_size(self, name, size):
+        with self.lock:
+            self.sizes[name] = self.sizes.get(name, 0) + size
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+    def to_record(self):
+        with self.lock:
+            return {
+                "step": self.step,
+                "started_at": self.started_at,
+                "total": time.time() - self.started_at,
+                "outcome": self.outcome,
+                "stages": dict(self.stages),
+                "sizes": dict(self.sizes),
+                "counts": dict(self.counts),
+            }
+
+
+class StepRecorder:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        existing = [name for name in os.listdir(directory) if name.startswith("step_") and name.endswith(".json")]
+        self.count = len(existing)
+        self.lock = Lock()
+
+    def record(self, objective, screenshot_data, mime_type, image_size, parser_output, response_text):
+        with self.lock:
+            self.count += 1
+            name = f"step_{self.count:04d}"
+            extension = mime_type.split("/")[-1]
+            with open(os.path.join(self.directory, f"{name}.{extension}"), 'wb') as f:
+                f.write(screenshot_data)
+            with open(os.path.join(self.directory, f"{name}.json"), 'w') as f:
+                json.dump({
+                    "objective": objective,
+                    "image": f"{name}.{extension}",
+                    "image_size": list(image_size),
+                    "parser_output": {
+                        "text": parser_output["text"],
+                        "coordinates": parser_output["coordinates"],
+                    },
+                    "response": response_text,
+                }, f, indent=2)
+
+
+class ScreenshotStore:
+    # Sizes of the encoded images on disk by name, oldest first. Files left in the
+    # directory by earlier runs are removed; kept ones live in its "kept" subdirectory.
+    def __init__(self, directory=None, max_count=None, max_bytes=None):
+        self.directory = screenshot_dir if directory is None else directory
+        self.max_count = screenshot_keep_count if max_count is None else max_count
+        self.max_bytes = screenshot_keep_bytes if max_bytes is None else max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.evicted = 0
+        self.kept = 0
+        self.lock = Lock()
+        if self.directory:
+            os.makedirs(os.path.join(self.directory, "kept"), exist_ok=True)
+            for name in os.listdir(self.directory):
+                if name.startswith("screenshot_"):
+                    self._remove_file(name)
+
+    def _remove_file(self, name):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    def put(self, name, data):
+        if not self.directory:
+            return
+        with self.lock:
+            if name in self.entries:
+                self.total_bytes -= self.entries.pop(name)
+            with open(os.path.join(self.directory, name), 'wb') as f:
+                f.write(data)
+            self.entries[name] = len(data)
+            self.total_bytes += len(data)
+            while len(self.entries) > 1 and (
+                    len(self.entries) > self.max_count or self.total_bytes > self.max_bytes):
+                evicted, evicted_size = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.evicted += 1
+                self._remove_file(evicted)
+
+    def keep(self, prefix):
+        # Moves the images whose names start with prefix out of the budget, e.g. those
+        # of a failed step; without a directory there is nowhere to keep them
+        if not self.directory:
+            return 0
+        with self.lock:
+            names = [name for name in self.entries if name.startswith(prefix)]
+            for name in names:
+                self.total_bytes -= self.entries.pop(name)
+                os.replace(os.path.join(self.directory, name), os.path.join(self.directory, "kept", name))
+            self.kept += len(names)
+            return len(names)
+
+    def stats(self):
+        with self.lock:
+            return (
+                f"{len(self.entries)} images, {self.total_bytes / (1024 * 1024):.1f} MB, "
+                f"{self.evicted} evicted, {self.kept} kept"
+            )
 
-class ScrollableLabel(ScrollView):
-    text = ObjectProperty('')
 
+def load_recording(directory):
+    steps = []
+    for name in sorted(os.listdir(directory)):
+        if name.startswith("step_") and name.endswith(".json"):
+            with open(os.path.join(directory, name)) as f:
+                step = json.load(f)
+            with open(os.path.join(directory, step["image"]), 'rb') as f:
+                step["image_data"] = f.read()
+            steps.append(step)
+    return steps
+
+
+class MetricsRecorder:
+    def __init__(self, path=None, prometheus_path=None, window=None):
+        self.path = metrics_path if path is None else path
+        self.prometheus_path = metrics_prometheus_path if prometheus_path is None else prometheus_path
+        self.records = deque(maxlen=window or metrics_window)
+        self.lock = Lock()
+        # The first failed write, until taken; later failures are not reported again
+        self.write_failed = False
+        self.write_error = None
+
+    def record(self, step_metrics):
+        record = step_metrics.to_record()
+        with self.lock:
+            self.records.append(record)
+            if self.path:
+                self._write(append_rotating, self.path, json.dumps(record) + "\n")
+            if self.prometheus_path:
+                self._write(self._write_prometheus)
+        return record
+
+    def _write(self, write, *args):
+        try:
+            write(*args)
+        except OSError as e:
+            # The in-memory window still feeds the summary
+            if not self.write_failed:
+                self.write_failed = True
+                self.write_error = e
+
+    def _write_prometheus(self):
+        # Replaced in one go so a scraper never reads a partial file
+        temp_path = self.prometheus_path + ".tmp"
+        with open(temp_path, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(temp_path, self.prometheus_path)
+
+    def take_write_error(self):
+        with self.lock:
+            error, self.write_error = self.write_error, None
+            return error
+
+    def stage_values(self):
+        values = {}
+        for record in self.records:
+            for stage, seconds in record["stages"].items():
+                values.setdefault(stage, []).append(seconds)
+            values.setdefault("total", []).append(record["total"])
+        return values
+
+    def summary(self):
+        return {
+            stage: (percentile(seconds, 0.5), percentile(seconds, 0.95))
+            for stage, seconds in self.stage_values().items()
+        }
+
+    def summary_text(self, stages=None):
+        summary = self.summary()
+        if stages is not None:
+            summary = {stage: summary[stage] for stage in stages if stage in summary}
+        if not summary:
+            return "No steps recorded"
+        return " | ".join(
+            f"{stage} {p50 * 1000:.0f}/{p95 * 1000:.0f}ms"
+            for stage, (p50, p95) in summary.items()
+        ) + " (p50/p95)"
+
+    def prometheus_text(self):
+        lines = [
+            "# HELP omnicontrol_stage_seconds Agent step stage duration in seconds.",
+            "# TYPE omnicontrol_stage_seconds summary",
+        ]
+        for stage, seconds in self.stage_values().items():
+            for quantile in (0.5, 0.95):
+                lines.append(
+                    f'omnicontrol_stage_seconds{{stage="{stage}",quantile="{quantile}"}} '
+                    f'{percentile(seconds, quantile):.6f}'
+                )
+            lines.append(f'omnicontrol_stage_seconds_sum{{stage="{stage}"}} {sum(seconds):.6f}')
+            lines.append(f'omnicontrol_stage_seconds_count{{stage="{stage}"}} {len(seconds)}')
+        sizes, counts = {}, {}
+        for record in self.records:
+            for name, size in record["sizes"].items():
+                sizes[name] = sizes.get(name, 0) + size
+            for name, amount in record["counts"].items():
+                counts[name] = counts.get(name, 0) + amount
+        # Sums over the last metrics_window steps, so they can go down: gauges, not counters
+        lines.append("# HELP omnicontrol_payload_bytes Payload bytes over the last recorded steps.")
+        lines.append("# TYPE omnicontrol_payload_bytes gauge")
+        for name, size in sizes.items():
+            lines.append(f'omnicontrol_payload_bytes{{payload="{name}"}} {size}')
+        lines.append("# HELP omnicontrol_events Event count over the last recorded steps.")
+        lines.append("# TYPE omnicontrol_events gauge")
+        for name, amount in counts.items():
+            lines.append(f'omnicontrol_events{{event="{name}"}} {amount}')
+        return "\n".join(lines) + "\n"
+
+
+def encode_screenshot(image, fmt=None, quality=None, max_size=None, resample=PIL.Image.LANCZOS):
+    fmt = (fmt or capture_format).upper()
+    quality = capture_quality if quality is None else quality
+    max_size = capture_max_size if max_size is None else max_size
+    if fmt not in capture_mime_types:
+        raise ValueError(f"Unsupported capture format: {fmt}")
+
+    # The parser returns coordinates as ratios of the image it received,
+    # so downscaling here does not affect the mapping back to screen pixels.
+    if max_size and (image.width > max_size[0] or image.height > max_size[1]):
+        image = image.copy()
+        image.thumbnail(max_size, resample)
+
+    if fmt in ("JPEG", "WEBP") and image.mode != "RGB":
+        image = image.convert("RGB")
+
+    buffer = io.BytesIO()
+    if fmt == "PNG":
+        image.save(buffer, format=fmt, compress_level=1)
+    else:
+        image.save(buffer, format=fmt, quality=quality)
+    return buffer.getvalue(), capture_mime_types[fmt], image.size
+
+
+def mask_region(image, rect, color=None):
+    left, top, right, bottom = rect
+    left, top = max(0, left), max(0, top)
+    right, bottom = min(image.width, right), min(image.height, bottom)
+    if right <= left or bottom <= top:
+        return image
+    masked = image.copy()
+    masked.paste(color or app_mask_color, (left, top, right, bottom))
+    return masked
+
+
+def focused_window_rect():
+    # Screen rectangle of the focused X11 window; None when it cannot be determined
+    try:
+        output = subprocess.run(
+            ["xdotool", "getactivewindow", "getwindowgeometry", "--shell"],
+            capture_output=True, text=True, timeout=1, check=True
+        ).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+    values = dict(line.split("=", 1) for line in output.splitlines() if "=" in line)
+    try:
+        x, y, width, height = (int(values[key]) for key in ("X", "Y", "WIDTH", "HEIGHT"))
+    except (KeyError, ValueError):
+        return None
+    return x, y, x + width, y + height
+
+
+def screen_fingerprint(image, size=None):
+    return image.resize(size or fingerprint_size, PIL.Image.BOX).convert("L").tobytes()
+
+
+def fingerprint_similarity(a, b, tolerance=None):
+    if not a or len(a) != len(b):
+        return 0.0
+    tolerance = fingerprint_tolerance if tolerance is None else tolerance
+    matching = sum(1 for x, y in zip(a, b) if abs(x - y) <= tolerance)
+    return matching / len(a)
+
+
+def wait_for_settle(capture_frame, stable_time=None, timeout=None, sleep=time.sleep, on_stable=None):
+    # Returns (seconds waited, whether the screen settled before the timeout, last frame).
+    # on_stable(frame) is called each time the screen starts a stable stretch, and on
+    # every following quiet sample for as long as it returns False.
+    stable_time = settle_stable_time if stable_time is None else stable_time
+    timeout = settle_timeout if timeout is None else timeout
+    start = time.monotonic()
+    previous = capture_frame()
+    stable_since = start
+    notified = False
+    while True:
+        sleep(settle_interval)
+        frame = capture_frame()
+        now = time.monotonic()
+        if fingerprint_similarity(previous, frame) < settle_threshold:
+            stable_since = now
+            notified = False
+        elif on_stable is not None and not notified:
+            notified = on_stable(frame) is not False
+        previous = frame
+        if now - stable_since >= stable_time:
+            return now - start, True, frame
+        if now - start >= timeout:
+            return now - start, False, frame
+
+
+class ParserCache:
+    def __init__(self, max_entries=None, ttl=None, threshold=None):
+        self.max_entries = parser_cache_size if max_entries is None else max_entries
+        self.ttl = parser_cache_ttl if ttl is None else ttl
+        self.threshold = parser_cache_threshold if threshold is None else threshold
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        expired = [key for key, (stored_at, _, _) in self.entries.items() if now - stored_at > self.ttl]
+        for key in expired:
+            del self.entries[key]
+
+    def lookup(self, fingerprint, image_size):
+        with self.lock:
+            self._evict_expired()
+            best_key, best_similarity = None, 0.0
+            if fingerprint in self.entries and self.entries[fingerprint][1] == image_size:
+                best_key, best_similarity = fingerprint, 1.0
+            else:
+                for key, (_, size, _) in self.entries.items():
+                    if size != image_size:
+                        continue
+                    similarity = fingerprint_similarity(fingerprint, key)
+                    if similarity > best_similarity:
+                        best_key, best_similarity = key, similarity
+
+            if best_key is None or best_similarity < self.threshold:
+                self.misses += 1
+                return None, best_similarity
+
+            self.hits += 1
+            self.entries.move_to_end(best_key)
+            return self.entries[best_key][2], best_similarity
+
+    def store(self, fingerprint, image_size, output):
+        with self.lock:
+            self.entries[fingerprint] = (time.monotonic(), image_size, output)
+            self.entries.move_to_end(fingerprint)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        return f"hits={self.hits} misses={self.misses} entries={len(self.entries)}"
+
+
+def normalize_objective(text):
+    return " ".join(text.lower().split()).rstrip(".!?")
+
+
+class TrajectoryCache:
+    # Executed steps of earlier jobs, persisted as JSON. Each entry holds the normalized
+    # objective, the screen fingerprint the step started from, the actions with their
+    # target boxes, and how much parser and model time a replay saves.
+    def __init__(self, path=None, max_entries=None, threshold=None):
+        self.path = trajectory_cache_path if path is None else path
+        self.max_entries = trajectory_cache_size if max_entries is None else max_entries
+        self.threshold = trajectory_cache_threshold if threshold is None else threshold
+        self.entries = []
+        self.lock = Lock()
+        self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+            for entry in data["entries"]:
+                entry["fingerprint"] = base64.b64decode(entry["fingerprint"])
+                self.entries.append(entry)
+        except (OSError, ValueError, KeyError):
+            # An unreadable store only costs the cached steps
+            self.entries = []
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            entries = [
+                {**entry, "fingerprint": base64.b64encode(entry["fingerprint"]).decode("ascii")}
+                for entry in self.entries
+            ]
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        temp_path = self.path + ".tmp"
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.chmod(temp_path, 0o600)
+        with open(fd, "w", encoding="utf-8") as f:
+            json.dump({"entries": entries}, f)
+        os.replace(temp_path, self.path)
+
+    def _matches(self, entry, objective, fingerprint, image_size):
+        if entry["objective"] != objective or tuple(entry["image_size"]) != tuple(image_size):
+            return 0.0
+        return fingerprint_similarity(fingerprint, entry["fingerprint"])
+
+    def lookup(self, objective, fingerprint, image_size):
+        objective = normalize_objective(objective)
+        with self.lock:
+            best, best_similarity = None, 0.0
+            for entry in self.entries:
+                similarity = self._matches(entry, objective, fingerprint, image_size)
+                if similarity > best_similarity:
+                    best, best_similarity = entry, similarity
+            if best is None or best_similarity < self.threshold:
+                return None, best_similarity
+            best["last_used"] = time.time()
+            return best, best_similarity
+
+    def store(self, objective, fingerprint, image_size, actions, response, cost):
+        objective = normalize_objective(objective)
+        now = time.time()
+        with self.lock:
+            # A new step from the same screen supersedes the old one
+            self.entries = [
+                entry for entry in self.entries
+                if self._matches(entry, objective, fingerprint, image_size) < self.threshold
+            ]
+            self.entries.append({
+                "objective": objective,
+                "fingerprint": fingerprint,
+                "image_size": list(image_size),
+                "actions": actions,
+                "response": response,
+                "cost": cost,
+                "hits": 0,
+                "failures": 0,
+                "created": now,
+                "last_used": now,
+            })
+            while len(self.entries) > self.max_entries:
+                self.entries.remove(min(self.entries, key=self._score))
+        self.save()
+
+    def record_replay(self, entry, ok):
+        with self.lock:
+            entry["hits" if ok else "failures"] += 1
+            # Steps that keep diverging are dropped rather than retried
+            if entry["failures"] >= trajectory_max_failures and entry["failures"] > entry["hits"]:
+                if entry in self.entries:
+                    self.entries.remove(entry)
+        self.save()
+
+    def _score(self, entry):
+        # Eviction order: smoothed hit rate, weighted up by use and down by days idle
+        hit_rate = (entry["hits"] + 1) / (entry["hits"] + entry["failures"] + 2)
+        idle_days = (time.time() - entry["last_used"]) / 86400
+        return hit_rate * math.log(2 + entry["hits"]) / (1 + idle_days)
+
+    def stats(self):
+        with self.lock:
+            hits = sum(entry["hits"] for entry in self.entries)
+            failures = sum(entry["failures"] for entry in self.entries)
+            return f"entries={len(self.entries)} replays={hits} diverged={failures}"
+
+
+# OmniParser label coordinates are [x, y, width, height] ratios of the parsed image.
+def box_to_xyxy(box):
+    x, y, w, h = box
+    return x, y, x + w, y + h
+
+
+def xyxy_to_box(x0, y0, x1, y1):
+    return [x0, y0, x1 - x0, y1 - y0]
+
+
+def box_iou(a, b):
+    ax0, ay0, ax1, ay1 = box_to_xyxy(a)
+    bx0, by0, bx1, by1 = box_to_xyxy(b)
+    iw = max(0.0, min(ax1, bx1) - max(ax0, bx0))
+    ih = max(0.0, min(ay1, by1) - max(ay0, by0))
+    intersection = iw * ih
+    union = a[2] * a[3] + b[2] * b[3] - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def diff_frame(image):
+    scale = diff_width / image.width
+    size = (diff_width, max(1, round(image.height * scale)))
+    return image.resize(size, PIL.Image.BOX).convert("L")
+
+
+def changed_regions(previous_frame, frame, image_size):
+    # Returns pixel boxes (x0, y0, x1, y1) around the changed tiles,
+    # or None when a full parse is cheaper or the frames are not comparable.
+    if previous_frame is None or previous_frame.size != frame.size:
+        return None
+
+    columns, rows = diff_grid
+    mask = ImageChops.difference(previous_frame, frame).point(lambda v: 255 if v > diff_tolerance else 0)
+    tiles = mask.convert("F").resize(diff_grid, PIL.Image.BOX).load()
+    dirty = {(cx, cy) for cx in range(columns) for cy in range(rows) if tiles[cx, cy] > 0}
+    if not dirty:
+        return []
+
+    # Group touching tiles and take the bounding box of each group
+    tile_width = image_size[0] / columns
+    tile_height = image_size[1] / rows
+    boxes = []
+    while dirty:
+        stack = [dirty.pop()]
+        min_x = max_x = stack[0][0]
+        min_y = max_y = stack[0][1]
+        while stack:
+            cx, cy = stack.pop()
+            min_x, max_x = min(min_x, cx), max(max_x, cx)
+            min_y, max_y = min(min_y, cy), max(max_y, cy)
+            for neighbour in ((cx + 1, cy), (cx - 1, cy), (cx, cy + 1), (cx, cy - 1)):
+                if neighbour in dirty:
+                    dirty.remove(neighbour)
+                    stack.append(neighbour)
+        boxes.append([
+            max(0, int(min_x * tile_width) - diff_region_padding),
+            max(0, int(min_y * tile_height) - diff_region_padding),
+            min(image_size[0], int((max_x + 1) * tile_width) + diff_region_padding),
+            min(image_size[1], int((max_y + 1) * tile_height) + diff_region_padding),
+        ])
+
+    # Padding can make neighbouring groups overlap; merge until stable
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    boxes[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+
+    changed_area = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in boxes)
+    if changed_area > diff_max_area * image_size[0] * image_size[1]:
+        return None
+    return [tuple(box) for box in boxes]
+
+
+# "Text Box ID 3: File" (labels may be empty) or "icon 3: {'type': 'text', 'content': 'File', ...}"
+element_line_pattern = re.compile(r"^(?P<kind>.*?(?:ID|[Ii]con|[Tt]ext)) (?P<id>\d+):(?: (?P<label>.*))?$")
+
+
+def parse_element_lines(text, strict=True):
+    # Maps element ID -> (kind, label). Strict parsing returns None if any line is not
+    # in the expected format; otherwise such lines continue the previous element's
+    # label (wrapped text) or are skipped.
+    elements = {}
+    previous = None
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        match = element_line_pattern.match(line.strip())
+        if not match:
+            if strict:
+                return None
+            if previous is not None:
+                kind, label = elements[previous]
+                elements[previous] = (kind, f"{label} {line.strip()}".strip())
+            continue
+        kind, label = match.group("kind"), match.group("label") or ""
+        if label.startswith("{"):
+            try:
+                details = ast.literal_eval(label)
+                kind, label = str(details.get("type", kind)), str(details.get("content") or "")
+            except (ValueError, SyntaxError, AttributeError):
+                pass
+        previous = match.group("id")
+        elements[previous] = (kind, label)
+    return elements
+
+
+class ElementTable:
+    # Parser output in pixel space, parsed once per screen: one row per element with
+    # boxes and centres in flat arrays, bucketed into a grid for point and overlap queries
+    def __init__(self, parser_output, image_size):
+        width, height = image_size
+        elements = parse_element_lines(parser_output["text"], strict=False)
+        self.image_size = image_size
+        self.text = parser_output["text"]
+        self.ids = []
+        self.rows = {}
+        self.kinds = []
+        self.labels = []
+        self.x0, self.y0, self.x1, self.y1 = array('d'), array('d'), array('d'), array('d')
+        self.cx, self.cy = array('d'), array('d')
+        for element_id, box in parser_output["coordinates"].items():
+            element_id = str(element_id)
+            x0, y0, x1, y1 = box_to_xyxy(box)
+            self.rows[element_id] = len(self.ids)
+            self.ids.append(element_id)
+            kind, label = elements.get(element_id, (None, ""))
+            self.kinds.append(kind)
+            self.labels.append(label)
+            self.x0.append(x0 * width)
+            self.y0.append(y0 * height)
+            self.x1.append(x1 * width)
+            self.y1.append(y1 * height)
+            self.cx.append((x0 + x1) / 2 * width)
+            self.cy.append((y0 + y1) / 2 * height)
+
+        self.cell = element_index_cell
+        self.columns = max(1, math.ceil(width / self.cell))
+        self.grid_rows = max(1, math.ceil(height / self.cell))
+        self.boxes_grid = {}
+        for index in range(len(self.ids)):
+            column0, row0 = self._cell(self.x0[index], self.y0[index])
+            column1, row1 = self._cell(self.x1[index], self.y1[index])
+            for column in range(column0, column1 + 1):
+                for row in range(row0, row1 + 1):
+                    self.boxes_grid.setdefault((column, row), []).append(index)
+
+    def _cell(self, x, y):
+        column = min(self.columns - 1, max(0, int(x // self.cell)))
+        row = min(self.grid_rows - 1, max(0, int(y // self.cell)))
+        return column, row
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __contains__(self, element_id):
+        return str(element_id) in self.rows
+
+    def box(self, element_id):
+        index = self.rows[str(element_id)]
+        return self.x0[index], self.y0[index], self.x1[index], self.y1[index]
+
+    def center(self, element_id):
+        index = self.rows[str(element_id)]
+        return self.cx[index], self.cy[index]
+
+    def kind(self, element_id):
+        return self.kinds[self.rows[str(element_id)]]
+
+    def label(self, element_id):
+        return self.labels[self.rows[str(element_id)]]
+
+    def at(self, x, y):
+        # Smallest element containing the point, e.g. the button rather than its toolbar
+        best, best_area = None, math.inf
+        for index in self.boxes_grid.get(self._cell(x, y), ()):
+            if self.x0[index] <= x <= self.x1[index] and self.y0[index] <= y <= self.y1[index]:
+                area = (self.x1[index] - self.x0[index]) * (self.y1[index] - self.y0[index])
+                if area < best_area:
+                    best, best_area = index, area
+        return None if best is None else self.ids[best]
+
+    def overlapping(self, x0, y0, x1, y1):
+        column0, row0 = self._cell(x0, y0)
+        column1, row1 = self._cell(x1, y1)
+        found = set()
+        for column in range(column0, column1 + 1):
+            for row in range(row0, row1 + 1):
+                for index in self.boxes_grid.get((column, row), ()):
+                    if index not in found and self.x0[index] < x1 and x0 < self.x1[index] \
+                            and self.y0[index] < y1 and y0 < self.y1[index]:
+                        found.add(index)
+        return [self.ids[index] for index in sorted(found)]
+
+def merge_region_outputs(previous_output, region_outputs, image_size):
+    previous_elements = parse_element_lines(previous_output["text"])
+    if previous_elements is None:
+        return None
+    previous = ElementTable(previous_output, image_size)
+    width, height = image_size
+    coordinates = dict(previous_output["coordinates"])
+    elements = dict(previous_elements)
+
+    # Elements centred inside a re-parsed region are replaced by the region results
+    dropped = {}
+    for (rx0, ry0, rx1, ry1), _ in region_outputs:
+        for element_id in previous.overlapping(rx0, ry0, rx1, ry1):
+            center_x, center_y = previous.center(element_id)
+            if element_id not in dropped and rx0 <= center_x <= rx1 and ry0 <= center_y <= ry1:
+                dropped[element_id] = (coordinates.pop(element_id), elements.pop(element_id, (None, None)))
+
+    next_id = max((int(element_id) for element_id in previous_output["coordinates"]), default=-1) + 1
+    for (rx0, ry0, rx1, ry1), output in region_outputs:
+        region_elements = parse_element_lines(output["text"])
+        if region_elements is None:
+            return None
+        region_width, region_height = rx1 - rx0, ry1 - ry0
+        for local_id, local_box in output["coordinates"].items():
+            x, y, w, h = local_box
+            box = [
+                (rx0 + x * region_width) / width,
+                (ry0 + y * region_height) / height,
+                w * region_width / width,
+                h * region_height / height,
+            ]
+            kind, label = region_elements.get(str(local_id), ("Icon Box ID", ""))
+
+            # Keep the ID of the element this one most likely replaces
+            element_id = None
+            best_iou = 0.5
+            x0, y0, x1, y1 = box_to_xyxy(box)
+            for dropped_id in previous.overlapping(x0 * width, y0 * height, x1 * width, y1 * height):
+                if dropped_id not in dropped:
+                    continue
+                dropped_box, (_, dropped_label) = dropped[dropped_id]
+                iou = box_iou(box, dropped_box)
+                if dropped_label == label and iou >= best_iou:
+                    element_id, best_iou = dropped_id, iou
+            if element_id is None:
+                element_id = str(next_id)
+                next_id += 1
+            else:
+                del dropped[element_id]
+
+            coordinates[element_id] = box
+            elements[element_id] = (kind, label)
+
+    ordered_ids = sorted(coordinates, key=int)
+    text = "\n".join(f"{elements[element_id][0]} {element_id}: {elements[element_id][1]}" for element_id in ordered_ids)
+    coordinates = {element_id: coordinates[element_id] for element_id in ordered_ids}
+    return {
+        "url": None,
+        "text": text,
+        "coordinates": coordinates
+    }
+
+
+annotation_fonts = {}
+
+
+def annotation_font(size):
+    if size not in annotation_fonts:
+        try:
+            annotation_fonts[size] = ImageFont.load_default(size=size)
+        except TypeError:
+            # Pillow < 10.1 only ships the fixed-size bitmap font
+            annotation_fonts[size] = ImageFont.load_default()
+    return annotation_fonts[size]
+
+
+def annotate_screenshot(image, elements, style=None):
+    style = {**annotation_style, **(style or {})}
+    font = annotation_font(style["label_size"])
+    annotated = image.convert("RGB")
+    draw = ImageDraw.Draw(annotated)
+    for element_id in elements:
+        rect = elements.box(element_id)
+        draw.rectangle(rect, outline=style["box_color"], width=style["box_thickness"])
+
+        # Label sits above the box, or inside it at the top edge of the screen
+        label = str(element_id)
+        left, top, right, bottom = draw.textbbox((0, 0), label, font=font)
+        label_x = rect[0]
+        label_y = rect[1] - (bottom - top) - 2
+        if label_y < 0:
+            label_y = rect[1]
+        draw.rectangle(
+            (label_x, label_y, label_x + right - left + 4, label_y + bottom - top + 2),
+            fill=style["label_background"]
+        )
+        draw.text((label_x + 2 - left, label_y + 1 - top), label, fill=style["label_color"], font=font)
+    return annotated
+
+
+def compact_element_list(elements, min_size=None, drop_unlabeled=None):
+    # "ID: label" lines under one heading per kind; IDs sharing a label go on one line.
+    # Parser text we cannot read at all is passed on as it is.
+    if len(elements) and all(kind is None for kind in elements.kinds):
+        return elements.text, len(elements)
+    min_size = model_min_element_size if min_size is None else min_size
+    drop_unlabeled = model_drop_unlabeled if drop_unlabeled is None else drop_unlabeled
+    groups = {}
+    listed = 0
+    for element_id in elements:
+        x0, y0, x1, y1 = elements.box(element_id)
+        if x1 - x0 < min_size or y1 - y0 < min_size:
+            continue
+        kind = elements.kind(element_id)
+        label = " ".join(elements.label(element_id).split())
+        # Only a label the parser reported as empty counts as unlabeled; a missing one is unknown
+        if kind is not None and not label and drop_unlabeled:
+            continue
+        kind = (kind or "Other").removesuffix(" Box ID")
+        label = label or "(no label)"
+        groups.setdefault(kind, {}).setdefault(label, []).append(element_id)
+        listed += 1
+
+    lines = []
+    for kind, labels in groups.items():
+        lines.append(f"{kind}:")
+        lines.extend(f"{','.join(ids)}: {label}" for label, ids in labels.items())
+    return "\n".join(lines), listed
+
+
+def focus_box(regions, image_size, padding=None):
+    # Padded bounding box of the changed regions; None if there is nothing to focus on
+    padding = model_focus_padding if padding is None else padding
+    if not regions:
+        return None
+    width, height = image_size
+    x0 = max(0, min(region[0] for region in regions) - padding)
+    y0 = max(0, min(region[1] for region in regions) - padding)
+    x1 = min(width, max(region[2] for region in regions) + padding)
+    y1 = min(height, max(region[3] for region in regions) + padding)
+    if (x1 - x0) * (y1 - y0) > diff_max_area * width * height:
+        return None
+    return x0, y0, x1, y1
+
+
+def estimate_image_tokens(size):
+    # Gemini counts small images as one 258-token tile, larger ones per 768x768 tile
+    width, height = size
+    if width <= 384 and height <= 384:
+        return 258
+    return math.ceil(width / 768) * math.ceil(height / 768) * 258
+
+
+class StepCancelled(BaseException):
+    # Like KeyboardInterrupt, not caught by the step's own error handling
+    pass
+
+
+class StepScheduler:
+    # Runs a job's steps one after another on a single thread until run_step()
+    # returns False or the job is cancelled; helper work goes through submit()
+    def __init__(self, run_step):
+        self.run_step = run_step
+        self.cancel_event = Event()
+        self.resume_event = Event()
+        self.resume_event.set()
+        self.paused_seconds = 0.0
+        # Set when a pause ended before the next step; cleared by whoever acts on it
+        self.resumed = False
+        self.thread = None
+
+    def start(self, on_exit=None):
+        self.thread = Thread(target=self._run, args=(on_exit,), daemon=True)
+        self.thread.start()
+
+    def _run(self, on_exit):
+        error = None
+        try:
+            while self.run_step():
+                self.check()
+                self._wait_while_paused()
+        except StepCancelled:
+            pass
+        except Exception as e:
+            error = e
+        finally:
+            if on_exit is not None:
+                on_exit(self.cancelled, error)
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def pause(self):
+        self.resume_event.clear()
+
+    def resume(self):
+        self.resume_event.set()
+
+    @property
+    def paused(self):
+        return not self.resume_event.is_set()
+
+    def _wait_while_paused(self):
+        # Pauses take effect between steps, so no batch of actions is left half done
+        if self.resume_event.is_set():
+            return
+        start = time.monotonic()
+        while not self.resume_event.wait(0.1):
+            self.check()
+        self.paused_seconds += time.monotonic() - start
+        self.resumed = True
+
+    def check(self):
+        if self.cancel_event.is_set():
+            raise StepCancelled()
+
+    def sleep(self, seconds):
+        if self.cancel_event.wait(seconds):
+            raise StepCancelled()
+
+    def submit(self, function, *args):
+        future = Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                self.check()
+                future.set_result(function(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+        Thread(target=run, daemon=True).start()
+        return future
+
+
+class Capture:
+    def __init__(self, screenshot, data, mime_type, name, metrics, rect=None):
+        self.screenshot = screenshot
+        self.size = screenshot.size
+        # Screen rectangle of the capture (None for the whole screen) and its top-left corner
+        self.rect = rect
+        self.origin = rect[:2] if rect is not None else (0, 0)
+        self.data = data
+        self.mime_type = mime_type
+        self.name = name
+        self.metrics = metrics
+        self.fingerprint = screen_fingerprint(screenshot)
+        self.diff_frame = diff_frame(screenshot)
+        self.settle_frame = None
+
+
+class EventLogRow(Label):
+    def __init__(self, **kwargs):
+        super(EventLogRow, self).__init__(**kwargs)
+        self.halign = 'left'
+        self.valign = 'middle'
+        self.shorten = True
+        self.shorten_from = 'right'
+        self.padding = (10, 0)
+        self.bind(size=self._set_text_size)
+
+    def _set_text_size(self, instance, size):
+        instance.text_size = size
+
+
+class EventLogView(RecycleView):
+    # Only the rows in view are rendered; multi-line events get one row per line and
+    # lines wider than the view are wrapped onto further rows
     def __init__(self, **kwargs):
-        super(ScrollableLabel, self).__init__(**kwargs)
-        self.label = Label(
-            text=self.text,
-            markup=True,
+        super(EventLogView, self).__init__(**kwargs)
+        self.viewclass = EventLogRow
+        self.events = []
+        self.columns = None
+        self.wrapped = {}
+        layout = RecycleBoxLayout(
+            default_size=(None, dp(20)),
+            default_size_hint=(1, None),
             size_hint_y=None,
-            padding=(10, 10)
+            orientation='vertical'
         )
-        self.label.bind(texture_size=self._set_label_height)
-        self.add_widget(self.label)
+        layout.bind(minimum_height=layout.setter('height'))
+        self.add_widget(layout)
+        self.bind(width=lambda *args: self._render())
+
+    def _rows(self, event):
+        rows = self.wrapped.get(event)
+        if rows is None:
+            rows = [
+                row
+                for line in event.splitlines() or ['']
+                for row in textwrap.wrap(line, self.columns, subsequent_indent='    ') or ['']
+            ]
+            self.wrapped[event] = rows
+        return rows
 
-    def _set_label_height(self, instance, size):
-        instance.height = size[1]
-        instance.text_size = (instance.width, None)
+    def _render(self):
+        # Characters per row, estimated from the default 15sp row font
+        columns = max(20, int((self.width - dp(20)) / (sp(15) * 0.6)))
+        if columns != self.columns or len(self.wrapped) > 2 * len(self.events):
+            self.columns = columns
+            self.wrapped = {}
+        follow = self.scroll_y <= 0.01 or not self.data
+        self.data = [{'text': row} for event in self.events for row in self._rows(event)]
+        if follow:
+            self.scroll_y = 0
 
-    def update_text(self, new_text):
-        self.label.text = new_text
+    def update_events(self, events):
+        self.events = events
+        self._render()
 
 
 class MyAppLayout(BoxLayout):
@@ -90,15 +1464,46 @@ class MyAppLayout(BoxLayout):
         
         # Initialize event log
         self.event_log = EventLog()
+        self.rendered_event_version = -1
+        self._event_log_trigger = Clock.create_trigger(self._refresh_event_log, 1.0 / event_log_refresh_rate)
+        self.parser_cache = ParserCache()
+        # Recent full-screen and region parse times, logged side by side
+        self.parse_times = {"full": deque(maxlen=20), "regions": deque(maxlen=20)}
+        self.trajectories = TrajectoryCache() if trajectory_cache_path else None
+        self.skip_trajectory = False
+        self.last_replayed = None
+        self.job_replayed = 0
+        self.job_saved = 0.0
+        self.parser_pool = ParserPool()
+        self.metrics = MetricsRecorder()
+        self.step_metrics = None
+        self.step_count = 0
+        self.recorder = StepRecorder(recording_dir) if recording_dir else None
+        self.screenshots = ScreenshotStore()
+        self.screenshot_name = None
+        self.step_screenshot = None
+        self.preview_texture = None
+        self.parser_output = None
+        self.elements = None
+        self.focus_box = None
+        self.capture_rect = None
+        self.capture_origin = (0, 0)
+        self.scope_window = None
+        self.previous_diff_frame = None
+        self.scheduler = None
+        self.speculation = None
+        self.settled_frame = None
+        self.model_future = None
+        self._update_app_rect()
+        Clock.schedule_interval(self._update_app_rect, 0.5)
         
-        # Initialize AI model
-        self.model = genai.GenerativeModel(
-            "gemini-2.0-flash-exp",
-            generation_config=genai.GenerationConfig(
-                response_mime_type="application/json",
-            ),
-            system_instruction=(
-                """
+        # The Gemini model is built by the warm-up after the first frame, or by the first job
+        self.model = None
+        self.chat = None
+        self.model_lock = Lock()
+        self.warm_up_times = {}
+        self.system_instruction = (
+            """
 You are an AI assistant designed to complete the user's objective by executing actions step-by-step on the user's machine. You are provided with an annotated screenshot of the user's screen, and have to determine the next best action to take in order to achieve the final goal. You can interact with the screen by clicking, typing, scrolling, right-clicking, or pressing keybinds. You should always follow this format when providing an action:
 
 [
@@ -110,7 +1515,7 @@ You are an AI assistant designed to complete the user's objective by executing a
     }
 ]
 
-You should only do one action at a time. Only respond with the next action to take.
+""" + (batch_action_policy if batch_actions else single_action_policy) + """
 
 Here are examples of valid actions:
 
@@ -163,10 +1568,15 @@ You need to think logically and efficiently. You should always consider the cont
         "action_type": "complete"
     }
 ]
-                """
-            )
+            """
         )
-        self.chat = self.model.start_chat()
+        self.chat_context = ChatContext()
+        # Objectives waiting to run, each {"objective", "source", "queued_at"}
+        self.job_queue = deque()
+        self.job = None
+        self.jobs_run = 0
+        self.paused = False
+        self.last_outcome = None
         
         # Create UI elements
         self._create_input_section()
@@ -176,27 +1586,94 @@ You need to think logically and efficiently. You should always consider the cont
         # Initialize processing state
         self.processing = False
         
+        startup_mark("layout")
         self.event_log.add_event("INIT", "Application started")
         self._update_event_log()
 
+    def _ensure_chat(self):
+        # Safe from any thread; a job started before the warm-up finished waits for it here
+        with self.model_lock:
+            if self.chat is None:
+                start = time.perf_counter()
+                genai.configure(api_key=os.environ["API_KEY"])
+                self.model = genai.GenerativeModel(
+                    "gemini-2.0-flash-exp",
+                    generation_config=genai.GenerationConfig(
+                        response_mime_type="application/json",
+                        response_schema=list[Action],
+                    ),
+                    system_instruction=self.system_instruction
+                )
+                self.chat = self.model.start_chat()
+                self.warm_up_times["model"] = time.perf_counter() - start
+        return self.chat
+
+    def log_startup(self):
+        phases = []
+        for (_, previous), (phase, at) in zip(startup_marks, startup_marks[1:]):
+            phases.append(f"{phase} {at - previous:.2f}s")
+        total = startup_marks[-1][1] - startup_marks[0][1]
+        self.event_log.add_event("INIT", f"Startup {total:.2f}s to first frame: {', '.join(phases)}")
+        self._update_event_log()
+
+    def start_warm_up(self):
+        Thread(target=self._warm_up, daemon=True).start()
+
+    def _warm_up(self):
+        # Off the UI thread: heavy imports, the model client and parser connections
+        start = time.perf_counter()
+        steps = (
+            ("pyautogui", pyautogui.load),
+            ("model", self._ensure_chat),
+            ("parser", self.parser_pool.warm_up),
+        )
+        for name, step in steps:
+            try:
+                step()
+            except Exception as e:
+                self.event_log.add_event("INIT", f"Warm-up of {name} failed: {e}")
+        parts = [f"import {name} {seconds:.2f}s" for name, seconds in lazy_import_times.items()]
+        parts += [f"{name} {seconds:.2f}s" for name, seconds in self.warm_up_times.items()]
+        self.event_log.add_event(
+            "INIT",
+            f"Warm-up {time.perf_counter() - start:.2f}s in the background: {', '.join(parts)}"
+        )
+        self._update_event_log()
+
     def _create_input_section(self):
         input_layout = BoxLayout(size_hint_y=None, height=50, spacing=10)
         
         self.user_input = TextInput(
-            hint_text='Enter your prompt here...',
+            hint_text='Enter your prompt here, or @file to queue one per line...',
             multiline=False,
-            size_hint_x=0.8
+            size_hint_x=0.55
         )
         
         start_button = Button(
             text='Start Job',
-            size_hint_x=0.2,
+            size_hint_x=0.15,
             background_color=(0.2, 0.6, 0.2, 1)
         )
         start_button.bind(on_press=self.start_job)
+
+        stop_button = Button(
+            text='Stop',
+            size_hint_x=0.15,
+            background_color=(0.7, 0.2, 0.2, 1)
+        )
+        stop_button.bind(on_press=self.cancel_job)
+
+        self.pause_button = Button(
+            text='Pause',
+            size_hint_x=0.15,
+            background_color=(0.6, 0.5, 0.2, 1)
+        )
+        self.pause_button.bind(on_press=self.toggle_pause)
         
         input_layout.add_widget(self.user_input)
         input_layout.add_widget(start_button)
+        input_layout.add_widget(self.pause_button)
+        input_layout.add_widget(stop_button)
         self.add_widget(input_layout)
 
     def _create_content_section(self):
@@ -220,7 +1697,7 @@ You need to think logically and efficiently. You should always consider the cont
             height=30,
         ))
         
-        self.event_view = ScrollableLabel(size_hint=(1, 1))
+        self.event_view = EventLogView(size_hint=(1, 1))
         right_panel.add_widget(self.event_view)
         
         content_layout.add_widget(left_panel)
@@ -236,316 +1713,1038 @@ You need to think logically and efficiently. You should always consider the cont
         )
         self.add_widget(self.status_label)
 
+        self.metrics_label = Label(
+            text='No steps recorded',
+            size_hint_y=None,
+            height=30,
+            font_size='12sp',
+            color=(0.7, 0.7, 0.7, 1),
+            halign='left',
+            shorten=True,
+            shorten_from='right'
+        )
+        self.metrics_label.bind(size=lambda instance, size: setattr(instance, 'text_size', size))
+        self.add_widget(self.metrics_label)
+
     def _update_event_log(self):
-        self.event_view.update_text(self.event_log.get_formatted_log())
+        # Safe from any thread; coalesced into one refresh per trigger interval
+        self._event_log_trigger()
+
+    def _refresh_event_log(self, *args):
+        events, version = self.event_log.get_events()
+        if version != self.rendered_event_version:
+            self.rendered_event_version = version
+            self.event_view.update_events(events)
+
+    def _call_on_main(self, function, *args):
+        # Kivy's Window belongs to the main thread; block the step thread until the call ran there
+        if current_thread() is main_thread():
+            return function(*args)
+        done = Event()
+        outcome = {}
+
+        def run(dt):
+            try:
+                outcome["result"] = function(*args)
+            except Exception as e:
+                outcome["error"] = e
+            finally:
+                done.set()
+
+        Clock.schedule_once(run)
+        while not done.wait(0.1):
+            self.scheduler.check()
+        if "error" in outcome:
+            raise outcome["error"]
+        return outcome.get("result")
+
+    def _set_status(self, text):
+        Clock.schedule_once(lambda dt: setattr(self.status_label, 'text', text))
+
+    def _set_window_opacity(self, opacity):
+        previous = Window.opacity
+        Window.opacity = opacity
+        return previous
 
     def hide_app(self):
         # Hide the app window
-        self.previous_opacity = Window.opacity
-        Window.opacity = 0
+        self.previous_opacity = self._call_on_main(self._set_window_opacity, 0)
         # Give some time for the window to hide
         time.sleep(0.2)
 
     def show_app(self):
         # Restore the app window
-        Window.opacity = self.previous_opacity
+        self._call_on_main(self._set_window_opacity, self.previous_opacity)
         # Give some time for the window to show
         time.sleep(0.2)
 
-    def take_screenshot(self, *args):
-        self.event_log.add_event("SCREEN", "Taking screenshot...")
+    def _update_app_rect(self, *args):
+        # Screen rectangle of our own window, widened to cover its decorations.
+        # Read on the main thread and cached for the step thread.
+        left, top = int(Window.left), int(Window.top)
+        width, height = Window.size
+        self.window_rect = (
+            left - app_mask_margin,
+            top - app_mask_margin,
+            left + int(width) + app_mask_margin,
+            top + int(height) + app_mask_margin
+        )
+
+    def app_rect(self):
+        return self.window_rect
+
+    def point_in_app(self, x, y):
+        left, top, right, bottom = self.app_rect()
+        return left <= x < right and top <= y < bottom
+
+    def _capture_rect(self):
+        # Screen rectangle the next capture is confined to; None for the whole screen
+        if capture_scope == "region":
+            rect = capture_region
+        elif capture_scope == "window":
+            rect = focused_window_rect()
+            if rect is None or self.point_in_app((rect[0] + rect[2]) / 2, (rect[1] + rect[3]) / 2):
+                # Our own window has focus after Start; stay on the last window the job used
+                rect = self.scope_window
+            else:
+                self.scope_window = rect
+        else:
+            return None
+        if rect is None:
+            return None
+        screen_width, screen_height = pyautogui.size()
+        left, top = max(0, rect[0]), max(0, rect[1])
+        right, bottom = min(screen_width, rect[2]), min(screen_height, rect[3])
+        if right - left < 16 or bottom - top < 16:
+            return None
+        return left, top, right, bottom
+
+    def _grab_screen(self, rect=None):
+        if rect is None:
+            screenshot = pyautogui.screenshot()
+            left, top = 0, 0
+        else:
+            left, top, right, bottom = rect
+            screenshot = pyautogui.screenshot(region=(left, top, right - left, bottom - top))
+        if not capture_hide_app:
+            app_left, app_top, app_right, app_bottom = self.app_rect()
+            screenshot = mask_region(screenshot, (app_left - left, app_top - top, app_right - left, app_bottom - top))
+        return screenshot
+
+    def _finish_step(self, outcome):
+        if screenshot_keep_on_error and outcome in failed_step_outcomes and self.step_screenshot:
+            kept = self.screenshots.keep(os.path.splitext(self.step_screenshot)[0])
+            if kept:
+                self.event_log.add_event("SCREEN", f"Kept {kept} image(s) of the failed step in {screenshot_dir}")
+        self.step_screenshot = None
+        self.last_outcome = outcome
+        if self.step_metrics is None:
+            return
+        self.step_metrics.outcome = outcome
+        record = self.metrics.record(self.step_metrics)
+        self.step_metrics = None
+        write_error = self.metrics.take_write_error()
+        if write_error is not None:
+            self.event_log.add_event("METRICS", f"Could not write metrics files, keeping them in memory only: {write_error}")
+
+        stages = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in record["stages"].items())
+        self.event_log.add_event("METRICS", f"Step {record['step']} ({outcome}) {record['total']:.2f}s: {stages}")
         self._update_event_log()
-        self.status_label.text = "Taking screenshot..."
+        summary = self.metrics.summary_text(metrics_label_stages)
+        Clock.schedule_once(lambda dt: setattr(self.metrics_label, 'text', summary))
+
+    def _run_step(self):
+        # One capture -> parse -> model -> actions cycle on the scheduler thread.
+        # Returns whether the job should take another step.
+        if self.scheduler.resumed:
+            self.scheduler.resumed = False
+            if self.speculation is not None:
+                # The screen may have changed while paused; the speculation must match it as it is now
+                self.settled_frame = self._settle_frame()
+        had_speculation = self.speculation is not None
+        speculated = self._adopt_speculation()
+        self.step_count += 1
+        if speculated is not None:
+            capture, parsed_output = speculated
+            self.step_metrics = capture.metrics
+        else:
+            self.step_metrics = StepMetrics(self.step_count)
+            if had_speculation:
+                self.step_metrics.count("speculation_miss")
+            self.event_log.add_event("SCREEN", "Taking screenshot...")
+            self._update_event_log()
+            self._set_status("Taking screenshot...")
+            try:
+                capture = self._capture(self.step_metrics)
+            except Exception as e:
+                error_msg = f"Error taking screenshot: {str(e)}"
+                self.event_log.add_event("ERROR", error_msg)
+                self._update_event_log()
+                self._set_status(error_msg)
+                self._finish_step("capture_error")
+                return False
+            parsed_output = None
+        self.step_screenshot = capture.name
+
+        # A step taken from this screen before is replayed without the parser or model
+        entry = self._lookup_trajectory(capture)
+        if entry is not None:
+            return self._replay_step(capture, entry)
+
+        if parsed_output is None:
+            try:
+                parsed_output = self._process_with_omniparser(capture)
+            except Exception as e:
+                self._handle_parser_error(str(e))
+                return False
 
-        # Hide the app before taking the screenshot
-        self.hide_app()
-        # Schedule the screenshot after a short delay
-        Clock.schedule_once(self._capture_and_process, 0.5)
+        self._on_parser_output(capture, parsed_output)
+        # One model turn at a time: an earlier response may still be streaming after its batch stopped
+        while self.model_future is not None and not self.model_future.done():
+            self.scheduler.sleep(0.05)
+        self.action_queue = Queue()
+        self.model_future = self.scheduler.submit(self._process_with_ai)
+        return self._handle_ai_response()
 
-    def _capture_and_process(self, *args):
+    def _capture(self, metrics):
+        # Take screenshot and encode it once for this step
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+
+        # Hide the app before taking the screenshot
+        if capture_hide_app:
+            self.hide_app()
         try:
-            # Take and save screenshot
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            temp_dir = tempfile.gettempdir()
-            self.screenshot_path = os.path.join(temp_dir, f'screenshot_{timestamp}.png')
-            
-            screenshot = pyautogui.screenshot()
-            self.image_width, self.image_height = screenshot.size
-            screenshot.save(self.screenshot_path)
-            
+            with metrics.span("capture"):
+                rect = self._capture_rect()
+                screenshot = self._grab_screen(rect)
+        finally:
             # Restore the app window
-            self.show_app()
-            self.event_log.add_event("SCREEN", f"Screenshot saved: {self.screenshot_path}")
+            if capture_hide_app:
+                self.show_app()
+        with metrics.span("encode"):
+            data, mime_type, encoded_size = encode_screenshot(screenshot)
+            name = f'screenshot_{timestamp}.{capture_format.lower()}'
+            self.screenshots.put(name, data)
+        metrics.add_size("screenshot", len(data))
+
+        self.event_log.add_event(
+            "SCREEN",
+            f"Screenshot captured: {screenshot.size[0]}x{screenshot.size[1]}"
+            f"{f' at {rect[0]},{rect[1]}' if rect is not None else ''}, "
+            f"encoded {capture_format} {encoded_size[0]}x{encoded_size[1]} "
+            f"({len(data) // 1024} KB)"
+        )
+        self._update_event_log()
+        return Capture(screenshot, data, mime_type, name, metrics, rect)
+
+    def _start_speculation(self, frame):
+        # The screen just went quiet after the last action: capture and parse it
+        # while the settle window runs out
+        self._discard_speculation()
+        self.event_log.add_event("SCREEN", "Screen quiet, capturing the next step speculatively")
+        self._update_event_log()
+        captured = Future()
+        metrics = StepMetrics(self.step_count + 1)
+        self.speculation = (captured, self.scheduler.submit(self._speculate, metrics, captured))
+
+    def _speculate(self, metrics, captured):
+        try:
+            capture = self._capture(metrics)
+            capture.settle_frame = screen_fingerprint(capture.screenshot, settle_frame_size)
+        except BaseException as e:
+            captured.set_exception(e)
+            raise
+        captured.set_result(capture)
+        if self.trajectories is not None:
+            entry, _ = self.trajectories.lookup(self.objective, capture.fingerprint, capture.size)
+            if entry is not None:
+                # Likely replayed without a parse; the step parses it if the replay is refused
+                return capture, None
+        return capture, self._process_with_omniparser(capture)
+
+    def _discard_speculation(self):
+        # Whatever is still in flight finishes in the background; its parse still lands in the cache
+        if self.speculation is not None:
+            self.speculation = None
+            self.event_log.add_event("SCREEN", "Speculative capture discarded")
             self._update_event_log()
-            
-            # Update screenshot display
-            Clock.schedule_once(lambda dt: self._update_screenshot(self.screenshot_path))
-            
-            # Process with OmniParser in a separate thread
-            Thread(target=self._process_with_omniparser).start()
-            
+
+    def _adopt_speculation(self):
+        # Returns (capture, parsed_output) if the speculative capture matches the settled screen
+        if self.speculation is None:
+            return None
+        captured, result = self.speculation
+        self.speculation = None
+        try:
+            capture = captured.result()
         except Exception as e:
-            error_msg = f"Error taking screenshot: {str(e)}"
-            self.event_log.add_event("ERROR", error_msg)
+            self.event_log.add_event("SCREEN", f"Speculative capture failed ({e}), capturing again")
             self._update_event_log()
-            self.status_label.text = error_msg
-            self.processing = False
+            return None
 
-    def _update_screenshot(self, path):
-        self.screenshot_image.source = path
-        self.screenshot_image.reload()
+        similarity = fingerprint_similarity(capture.settle_frame, self.settled_frame)
+        if similarity < settle_threshold:
+            self.event_log.add_event(
+                "SCREEN",
+                f"Screen changed after the speculative capture (similarity {similarity:.4f}), capturing again"
+            )
+            self._update_event_log()
+            return None
 
-    def _process_with_omniparser(self):
-        max_retries = 3
+        try:
+            _, parsed_output = result.result()
+        except Exception as e:
+            self.event_log.add_event("PARSER", f"Speculative parse failed ({e}), capturing again")
+            self._update_event_log()
+            return None
+
+        capture.metrics.count("speculation_hit")
+        self.event_log.add_event("SCREEN", f"Using the speculative capture (similarity {similarity:.4f})")
+        self._update_event_log()
+        return capture, parsed_output
+
+    def _lookup_trajectory(self, capture):
+        if self.trajectories is None:
+            return None
+        if self.skip_trajectory:
+            # The last replay from here diverged; let the model take this step
+            self.skip_trajectory = False
+            return None
+        entry, similarity = self.trajectories.lookup(self.objective, capture.fingerprint, capture.size)
+        last_replayed, self.last_replayed = self.last_replayed, None
+        if entry is None:
+            return None
+        if entry is last_replayed:
+            # The replayed actions left the screen as it was; repeating them would loop
+            self.trajectories.record_replay(entry, False)
+            self.event_log.add_event("CACHE", "Screen unchanged after the replayed step, asking the model")
+            self._update_event_log()
+            return None
+        self.event_log.add_event(
+            "CACHE",
+            f"Trajectory cache hit (similarity {similarity:.4f}), replaying {len(entry['actions'])} action(s)"
+        )
+        self._update_event_log()
+        return entry
+
+    def _replay_step(self, capture, entry):
+        # Runs a cached step's actions at their recorded positions. The parse and
+        # element table stay those of the last parsed screen.
+        self.step_metrics.count("trajectory_hit")
+        self.screenshot = capture.screenshot
+        self.image_width, self.image_height = capture.size
+        self.screenshot_data = capture.data
+        self.screenshot_mime = capture.mime_type
+        self.screenshot_name = capture.name
+        self.diff_frame = capture.diff_frame
+        self.capture_rect = capture.rect
+        self.capture_origin = capture.origin
+        self._show_preview(capture.screenshot)
+        self._set_status("Replaying cached step...")
+
+        actions = entry["actions"]
+        executed = []
+        action_type = None
+        before = capture.diff_frame
+        try:
+            for index, action in enumerate(actions):
+                action_type = action["action_type"]
+                self.event_log.add_event("CACHE", f"Replayed action {index + 1}: {action['description']}")
+                self._update_event_log()
+                if action_type == "complete":
+                    executed.append("complete")
+                    break
+
+                last = index == len(actions) - 1
+                target = action["target"]
+                box = tuple(target["box"]) if target else None
+                center = tuple(target["center"]) if target else None
+                self._perform_action(action_type, box, center, action.get("value", ""), last or action["changes_screen"])
+                executed.append(action["description"])
+                if last:
+                    break
+                after = diff_frame(self._grab_screen(self.capture_rect))
+                if self._unexpected_change(before, after, box):
+                    raise ValueError("unexpected screen change")
+                before = after
+        except Exception as e:
+            self.trajectories.record_replay(entry, False)
+            self.skip_trajectory = True
+            self.event_log.add_event("CACHE", f"Replay diverged ({e}), asking the model next step")
+            self._update_event_log()
+            self.chat_context.add_turn("Replayed a cached step.", entry["response"])
+            self.chat_context.record_outcome("; ".join(executed + [f"replay stopped: {e}"]))
+            self._finish_step("replay_diverged")
+            return True
+
+        self.trajectories.record_replay(entry, True)
+        self.last_replayed = entry
+        self.job_replayed += 1
+        self.job_saved += entry["cost"]
+        self.step_metrics.add("trajectory_saved", entry["cost"])
+        self.chat_context.add_turn("Replayed a cached step.", entry["response"])
+        self.chat_context.record_outcome("; ".join(executed) + " -> replayed")
+        if action_type == "complete":
+            self.event_log.add_event("JOB", "User objective completed.")
+            self._update_event_log()
+            self._set_status("Objective completed.")
+            self._finish_step("complete")
+            return False
+        self._set_status("Cached step replayed")
+        self._finish_step(action_type)
+        return True
+
+    def _trajectory_action(self, action, action_type, action_element_id, description):
+        target = None
+        if action_type in pointer_action_types:
+            target = {
+                "box": list(self.elements.box(action_element_id)),
+                "center": list(self.elements.center(action_element_id)),
+                "kind": self.elements.kind(action_element_id),
+                "label": self.elements.label(action_element_id),
+            }
+        return {
+            "action_type": action_type,
+            "value": action.get("value", ""),
+            "reasoning": action.get("reasoning", ""),
+            "changes_screen": action.get("changes_screen") in (True, "true", "True"),
+            "description": description,
+            "target": target,
+        }
+
+    def _store_trajectory(self, executed_actions):
+        if self.trajectories is None or not executed_actions:
+            return
+        # What a replay of this step saves: everything between capture and the first action
+        stages = self.step_metrics.to_record()["stages"]
+        cost = sum(
+            seconds for stage, seconds in stages.items()
+            if stage.startswith("parser") or stage in ("elements", "annotate", "model")
+        )
+        response = json.dumps([
+            {key: action[key] for key in ("reasoning", "action_type", "value") if action.get(key)}
+            for action in executed_actions
+        ])
+        try:
+            self.trajectories.store(
+                self.objective,
+                self.capture_fingerprint,
+                (self.image_width, self.image_height),
+                executed_actions,
+                response,
+                cost
+            )
+        except OSError as e:
+            self.event_log.add_event("CACHE", f"Could not save the trajectory cache: {e}")
+            self._update_event_log()
+
+    def _show_preview(self, image):
+        # Downscaled on the calling thread; only the texture upload runs on the main thread
+        preview = image.convert("RGB") if image.mode != "RGB" else image.copy()
+        preview.thumbnail(preview_max_size, PIL.Image.BOX)
+        size, data = preview.size, preview.tobytes()
+        Clock.schedule_once(lambda dt: self._update_preview(size, data))
+
+    def _update_preview(self, size, data):
+        # One texture is reused while the preview size stays the same
+        if self.preview_texture is None or tuple(self.preview_texture.size) != size:
+            self.preview_texture = Texture.create(size=size, colorfmt='rgb')
+            self.preview_texture.flip_vertical()
+        self.preview_texture.blit_buffer(data, colorfmt='rgb', bufferfmt='ubyte')
+        self.screenshot_image.texture = self.preview_texture
+        self.screenshot_image.canvas.ask_update()
+
+    def _request_parse(self, payload, metrics):
+        metrics.add_size("parser_upload", payload["data"][0]["size"])
+        output, endpoint, event_id = self.parser_pool.request(payload, metrics, self.scheduler.check)
+        self.event_log.add_event("PARSER", f"Processed by {endpoint.address}, event ID: {event_id}")
+        self._update_event_log()
+        return output
+
+    def _parse_changed_regions(self, capture, regions):
+        # Region results can only be merged into a parse whose text we understand
+        if parse_element_lines(self.parser_output["text"]) is None:
+            return None
+
+        start = time.perf_counter()
+        futures = []
+        for index, region in enumerate(regions):
+            crop = capture.screenshot.crop(region)
+            data, mime_type, _ = encode_screenshot(crop)
+            payload = build_parser_payload(data, mime_type, f"region_{index}.{capture_format.lower()}")
+            futures.append(self.scheduler.submit(self._request_parse, payload, capture.metrics))
+        region_outputs = [(region, future.result()) for region, future in zip(regions, futures)]
+
+        seconds = time.perf_counter() - start
+        self.parse_times["regions"].append(seconds)
+        full = percentile(list(self.parse_times["full"]), 0.5) if self.parse_times["full"] else None
+        self.event_log.add_event(
+            "PARSER",
+            f"Parsed {len(regions)} region(s) concurrently in {seconds:.2f}s"
+            + (f" (full parses p50 {full:.2f}s)" if full is not None else "")
+        )
+        return merge_region_outputs(self.parser_output, region_outputs, capture.size)
+
+    def _process_with_omniparser(self, capture):
+        # Returns the parsed output for the capture; raises once the retries are used up.
+        # Only reads the committed parse, so it can run ahead of the current step.
+        max_retries = parser_max_retries
         retries = 0
-        while retries < max_retries:
+        metrics = capture.metrics
+
+        # Reuse the parse of an identical or near-identical screen
+        image_size = capture.size
+        cached_output, similarity = self.parser_cache.lookup(capture.fingerprint, image_size)
+        if cached_output is not None:
+            metrics.count("parser_cache_hit")
+            self.event_log.add_event(
+                "PARSER",
+                f"Parser cache hit (similarity {similarity:.4f}, {self.parser_cache.stats()})"
+            )
+            self._update_event_log()
+            return cached_output
+        self.event_log.add_event(
+            "PARSER",
+            f"Parser cache miss (best similarity {similarity:.4f}, {self.parser_cache.stats()})"
+        )
+
+        # Only send the regions that changed since the last parsed screen
+        regions = None
+        if incremental_parsing and self.parser_output is not None:
+            regions = changed_regions(self.previous_diff_frame, capture.diff_frame, image_size)
+            if regions is not None:
+                changed_area = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in regions)
+                self.event_log.add_event(
+                    "PARSER",
+                    f"{len(regions)} changed region(s), "
+                    f"{changed_area / (image_size[0] * image_size[1]):.1%} of the screen"
+                )
+            if regions is not None and len(regions) > diff_max_regions:
+                # Each region is a round trip of its own; past a few, one full parse is quicker
+                self.event_log.add_event("PARSER", f"More than {diff_max_regions} regions, parsing full screen")
+                regions = None
+
+        # Base64 encode the in-memory capture once, not on every retry
+        payload = build_parser_payload(capture.data, capture.mime_type, capture.name)
+        while True:
             try:
                 self.event_log.add_event("PARSER", f"Processing with OmniParser... (Attempt {retries + 1}/{max_retries})")
                 self._update_event_log()
-                self.status_label.text = f"Processing with OmniParser... (Attempt {retries + 1}/{max_retries})"
-                
-                # Convert image to base64
-                with open(self.screenshot_path, "rb") as image_file:
-                    encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-                
-                # Prepare payload
-                payload = {
-                    "data": [
-                        {
-                            "url": f"data:image/png;base64,{encoded_string}",
-                            "size": os.path.getsize(self.screenshot_path),
-                            "orig_name": os.path.basename(self.screenshot_path),
-                            "mime_type": "image/png"
-                        },
-                        0.05,  # box_threshold
-                        0.1    # iou_threshold
-                    ]
-                }
-                
-                # Send POST request
-                post_url = parser_address + '/gradio_api/call/process'
-                post_response = requests.post(post_url, json=payload)
-                
-                if post_response.status_code != 200:
-                    raise Exception(f"POST request failed with status code {post_response.status_code}")
-                
-                # Get event_id
-                event_id = post_response.json().get('event_id')
-                self.event_log.add_event("PARSER", f"Processing event ID: {event_id}")
-                self._update_event_log()
-                
-                if not event_id:
-                    raise Exception("No event_id returned from POST request")
-                
-                # Poll for the result
-                get_url = parser_address + f'/gradio_api/call/process/{event_id}'
-                get_response = requests.get(get_url, stream=True)
-                
-                if get_response.status_code != 200:
-                    raise Exception(f"GET request failed with status code {get_response.status_code}")
-                
-                # Read the stream
-                result_data = None
-                for line in get_response.iter_lines(decode_unicode=True):
-                    if line and line.startswith('data:'):
-                        data_line = line[len('data:'):].strip()
-                        result_data = json.loads(data_line)
-                        if result_data:
-                            break
-
-                if result_data is None:
-                    raise Exception("No data received from GET request")
-
-                parsed_output = {
-                    "url": parser_address + f"/gradio_api/file={result_data[0].get('path')}",
-                    "text": result_data[1],
-                    "coordinates": ast.literal_eval(result_data[2])
-                }
-                
+                self._set_status(f"Processing with OmniParser... (Attempt {retries + 1}/{max_retries})")
+
+                parsed_output = None
+                if regions is not None:
+                    parsed_output = self._parse_changed_regions(capture, regions)
+                    if parsed_output is None:
+                        self.event_log.add_event("PARSER", "Could not merge region results, parsing full screen")
+                        regions = None
+                if parsed_output is None:
+                    start = time.perf_counter()
+                    parsed_output = self._request_parse(payload, metrics)
+                    self.parse_times["full"].append(time.perf_counter() - start)
+
                 self.event_log.add_event("PARSER", "OmniParser processing complete")
+                self.event_log.add_event("PARSER", f"Endpoints: {self.parser_pool.stats()}")
                 self._update_event_log()
 
-                self.parser_output = parsed_output  # Store parser output for later use
-
-                # Update screenshot with annotations
-                Clock.schedule_once(lambda dt: self._update_screenshot(parsed_output["url"]))
-
-                # Process with AI in a separate thread
-                Thread(target=self._process_with_ai).start()
-                
-                # Parsing succeeded, exit the retry loop
-                break
+                self.parser_cache.store(capture.fingerprint, image_size, parsed_output)
+                return parsed_output
 
             except Exception as e:
                 retries += 1
+                metrics.count("parser_retry")
                 error_message = str(e)
                 self.event_log.add_event("ERROR", f"Parser attempt {retries} failed: {error_message}")
                 self._update_event_log()
-                self.status_label.text = f"Parser attempt {retries} failed: {error_message}"
-                
+                self._set_status(f"Parser attempt {retries} failed: {error_message}")
+
                 if retries >= max_retries:
-                    # Handle the parser error after max retries
-                    Clock.schedule_once(lambda dt: self._handle_parser_error(error_message))
-                    break
-                else:
-                    # Wait before retrying
-                    time.sleep(1)
+                    raise
+                # Back off before retrying; the pool prefers a healthier endpoint next
+                self.scheduler.sleep(backoff_delay(retries))
+
+    def _on_parser_output(self, capture, parsed_output):
+        # Commit the capture and its parse as the current step's screen
+        self.screenshot = capture.screenshot
+        self.image_width, self.image_height = capture.size
+        self.screenshot_data = capture.data
+        self.screenshot_mime = capture.mime_type
+        self.screenshot_name = capture.name
+        self.diff_frame = capture.diff_frame
+        self.capture_rect = capture.rect
+        self.capture_origin = capture.origin
+        self.capture_fingerprint = capture.fingerprint
+        self.parser_output = parsed_output  # Store parser output for later use
+        self.focus_box = None
+        if model_focus_crop:
+            regions = changed_regions(self.previous_diff_frame, capture.diff_frame, capture.size)
+            self.focus_box = focus_box(regions, capture.size)
+        self.previous_diff_frame = capture.diff_frame
+        with self.step_metrics.span("elements"):
+            self.elements = ElementTable(parsed_output, capture.size)
+
+        # Draw the element boxes on the capture we already hold
+        with self.step_metrics.span("annotate"):
+            self.annotated_image = annotate_screenshot(self.screenshot, self.elements)
+
+        # Update screenshot with annotations
+        self._show_preview(self.annotated_image)
 
     def _process_with_ai(self):
+        # Producer side of the step: validated actions go into self.action_queue as they stream in
+        dispatched = False
+        # The step thread may move on to the next step before the response has fully streamed
+        metrics = self.step_metrics
+        action_queue = self.action_queue
+        scheduler = self.scheduler
+        chat_context = self.chat_context
+        objective = self.objective
+        screenshot_data, screenshot_mime = self.screenshot_data, self.screenshot_mime
+        screenshot_name = self.screenshot_name
+        image_size = (self.image_width, self.image_height)
+        parser_output = self.parser_output
+        elements = self.elements
+        annotated_image = self.annotated_image
+        changed_box = self.focus_box
         try:
             self.event_log.add_event("AI", "Starting AI analysis...")
             self._update_event_log()
             
-            # Download and load the annotated image from parser
-            annotated_image_response = requests.get(self.parser_output["url"])
-            temp_annotated_path = os.path.join(tempfile.gettempdir(), 'annotated.png')
-            with open(temp_annotated_path, 'wb') as f:
-                f.write(annotated_image_response.content)
-            
-            image = PIL.Image.open(temp_annotated_path)
-            
             # Prepare the prompt with the user's objective and parser output
-            prompt = [
-                image,
-                f"User objective:\n\n```\n{self.user_input.text}\n```\n\n"
-                f"Screen elements detected:\n\n```\n{self.parser_output['text']}\n```"
-            ]
-            
-            # Send to AI
-            response = self.chat.send_message(prompt)
-            
-            Clock.schedule_once(lambda dt: self._handle_ai_response(response.text))
+            with metrics.span("model_payload"):
+                images, prompt_text = self._build_model_payload(
+                    objective, screenshot_name, annotated_image, elements, changed_box, metrics
+                )
+
+            for attempt in range(model_max_reasks + 1):
+                stream_parser = ActionStreamParser()
+                actions = []
+                model_start = time.perf_counter()
+
+                def on_text(text):
+                    nonlocal dispatched
+                    # Stops reading the stream once the job is cancelled
+                    scheduler.check()
+                    for action in stream_parser.feed(text):
+                        if actions and not batch_actions:
+                            return
+                        self._validate_action(action, len(actions), elements)
+                        actions.append(action)
+                        action_queue.put(action)
+                        if not dispatched:
+                            # The step thread starts executing while the rest of the response streams in
+                            dispatched = True
+                            metrics.add("model_first_action", time.perf_counter() - model_start)
+
+                try:
+                    # Send to AI with a trimmed history
+                    with metrics.span("model"):
+                        response_text, input_stats = chat_context.send(self._ensure_chat(), images, prompt_text, on_text)
+                    if not actions:
+                        raise ValueError("AI response is not a list or is empty")
+                    action_queue.put(None)
+                    break
+                except ValueError as e:
+                    if dispatched:
+                        # Already acting on the valid actions; stop the batch there
+                        action_queue.put(e)
+                        response_text, input_stats = chat_context.turns[-1]["response"], None
+                        break
+                    if attempt >= model_max_reasks:
+                        raise
+                    metrics.count("model_reask")
+                    chat_context.record_outcome(f"invalid response: {e}")
+                    self.event_log.add_event("AI", f"Invalid response ({e}), asking again ({attempt + 1}/{model_max_reasks})")
+                    self._update_event_log()
+                    images = []
+                    prompt_text = (
+                        f"Your previous response was invalid: {e}\n"
+                        "Respond again with the next action(s) as a JSON list in the required format."
+                    )
+
+            self.event_log.add_event("AI", f"AI Response received:\n{response_text}")
+            metrics.add_size("model_response", len(response_text))
+            if input_stats is not None:
+                metrics.add_size("model_input_chars", input_stats["chars"])
+                self.event_log.add_event(
+                    "AI",
+                    f"Model input: {input_stats['chars']} chars, {input_stats['images']} image(s) "
+                    f"({input_stats['image_bytes'] / 1024:.0f} KB)"
+                )
+            self._update_event_log()
+
+            if self.recorder is not None:
+                self.recorder.record(
+                    objective,
+                    screenshot_data,
+                    screenshot_mime,
+                    image_size,
+                    parser_output,
+                    response_text
+                )
             
         except Exception as e:
-            error_message = str(e)
-            Clock.schedule_once(lambda dt: self._handle_ai_error(error_message))
+            # Before any action this fails the step, after it only stops the batch
+            action_queue.put(e)
+
+    def _build_model_payload(self, objective, screenshot_name, annotated_image, elements, changed_box, metrics):
+        data, mime_type, size = encode_screenshot(
+            annotated_image, model_image_format, model_image_quality, model_image_max_size or (),
+            # Bilinear keeps the labels legible at these ratios in a third of Lanczos' time
+            PIL.Image.BILINEAR
+        )
+        # What the model saw, next to the capture it came from
+        self.screenshots.put(f"{os.path.splitext(screenshot_name)[0]}_model.{model_image_format.lower()}", data)
+        images = [{"mime_type": mime_type, "data": data}]
+        image_tokens = estimate_image_tokens(size)
+        described = f"{size[0]}x{size[1]} image ({len(data) / 1024:.0f} KB)"
+
+        element_text, listed = compact_element_list(elements)
+        prompt_text = (
+            f"User objective:\n\n```\n{objective}\n```\n\n"
+            f"Screen elements detected (ID: label; IDs sharing a label are listed together):\n\n"
+            f"```\n{element_text}\n```"
+        )
 
-    def _handle_parser_error(self, error_message):
-        self.event_log.add_event("ERROR", f"Parser error: {error_message}")
-        self._update_event_log()
-        self.status_label.text = f"Error: {error_message}"
-        self.processing = False
+        if changed_box is not None:
+            crop = annotated_image.crop(changed_box)
+            crop_data, crop_mime, crop_size = encode_screenshot(
+                crop, model_image_format, model_image_quality, model_focus_max_size
+            )
+            images.append({"mime_type": crop_mime, "data": crop_data})
+            image_tokens += estimate_image_tokens(crop_size)
+            described += f" + {crop_size[0]}x{crop_size[1]} focus crop ({len(crop_data) / 1024:.0f} KB)"
+            x0, y0, x1, y1 = changed_box
+            prompt_text += (
+                f"\n\nThe second image is a close-up of the area that changed since the last step, "
+                f"screen pixels ({x0}, {y0}) to ({x1}, {y1})."
+            )
 
-    def _handle_ai_response(self, response_text):
-        self.event_log.add_event("AI", f"AI Response received:\n{response_text}")
+        metrics.add_size("model_image", sum(len(image["data"]) for image in images))
+        metrics.add_size("model_prompt_chars", len(prompt_text))
+        # About four characters per text token
+        tokens = image_tokens + len(prompt_text) // 4
+        metrics.add_size("model_turn_tokens", tokens)
+        self.event_log.add_event(
+            "AI",
+            f"Model payload: {described}, {listed}/{len(elements)} elements listed, "
+            f"~{tokens} tokens this turn"
+        )
         self._update_event_log()
-        self.status_label.text = "Executing action..."
+        return images, prompt_text
 
-        try:
-            # Parse the AI response
-            actions = json.loads(response_text)
-            if not isinstance(actions, list) or len(actions) == 0:
-                raise ValueError("AI response is not a list or is empty")
-            action = actions[0]
-            reasoning = action.get("reasoning", "")
-            action_type = action.get("action_type", "").lower()
-            action_element_id = action.get("action_element_id", "")
-            value = action.get("value", "")
-
-            # Log the action
-            self.event_log.add_event("AI", f"Action to perform: {action_type}")
-            if action_element_id:
-                self.event_log.add_event("AI", f"On element ID: {action_element_id}")
-            self.event_log.add_event("AI", f"Reasoning: {reasoning}")
-            self._update_event_log()
-
-            # Check for completion
-            if action_type == "complete":
-                self.event_log.add_event("JOB", "User objective completed.")
-                self._update_event_log()
-                self.status_label.text = "Objective completed."
-                self.processing = False
-                return  # Exit the loop
-
-            # ------------------------------------------------
-            # If there's no element ID or no action_type 
-            # when it is expected, raise an error
-            # (keybind does not necessarily need element_id).
-            # ------------------------------------------------
-            if action_type not in ["complete", "keybind"] and not action_element_id:
+    def _handle_parser_error(self, error_message):
+        self.event_log.add_event("ERROR", f"Parser error: {error_message}")
+        self._update_event_log()
+        self._set_status(f"Error: {error_message}")
+        self._finish_step("parser_error")
+
+    def _describe_action(self, action_type, action_element_id, value):
+        description = action_type
+        if action_element_id:
+            label = self.elements.label(action_element_id) if action_element_id in self.elements else ""
+            description += f" on element {action_element_id}"
+            if label:
+                description += f" ({label!r})"
+        if value:
+            description += f" with value {value!r}"
+        return description
+
+    def _validate_action(self, action, index, elements):
+        if not isinstance(action, dict):
+            raise ValueError("AI action is not an object")
+        if index >= batch_max_actions:
+            raise ValueError(f"AI returned more than {batch_max_actions} actions")
+        action_type = str(action.get("action_type", "")).lower()
+        action_element_id = str(action.get("action_element_id", "") or "")
+        if action_type not in action_types:
+            raise ValueError(f"Unknown or unhandled action type: {action_type}")
+        # Keybinds do not need an element ID
+        if action_type in pointer_action_types:
+            if not action_element_id:
                 raise ValueError("Action type requires an element ID, but none was provided.")
+            if action_element_id not in elements:
+                raise ValueError(f"No coordinates found for element ID {action_element_id}")
+        if action_type == "keybind" and not action.get("value"):
+            raise ValueError("No keybind specified")
 
-            if action_type in ["click", "right_click", "type", "scroll"]:
-                coordinates = self.parser_output['coordinates'].get(action_element_id)
-                if not coordinates:
-                    raise ValueError(f"No coordinates found for element ID {action_element_id}")
-
-                x_min_norm, y_min_norm, x_max_norm, y_max_norm = coordinates
-                x_min = x_min_norm * self.image_width
-                y_min = y_min_norm * self.image_height
-                x_max = x_max_norm * self.image_width
-                y_max = y_max_norm * self.image_height
-
-                # Get the center position
-                x_center = (x_min + (x_max / 2))
-                y_center = (y_min + (y_max / 2))
-
-                print(f"Action: {action_type}, Element ID: {action_element_id}, Value: {value}")
-                print(f"Coordinates: {x_min}, {y_min}, {x_max}, {y_max}")
-                print(f"Center Coordinates: {x_center}, {y_center}")
+    def _first_action(self):
+        # The producer always queues an action or the error that stopped it
+        while True:
+            self.scheduler.check()
+            try:
+                item = self.action_queue.get(timeout=0.1)
+            except Empty:
+                continue
+            if isinstance(item, Exception):
+                raise item
+            return item
+
+    def _next_action(self):
+        deadline = time.monotonic() + model_stream_timeout
+        while True:
+            self.scheduler.check()
+            try:
+                item = self.action_queue.get(timeout=0.1)
+                break
+            except Empty:
+                if time.monotonic() >= deadline:
+                    self.event_log.add_event("AI", "Timed out waiting for the rest of the AI response")
+                    return None
+        if isinstance(item, Exception):
+            self.event_log.add_event("AI", f"Stopping after the valid actions: {item}")
+            return None
+        return item
+
+    def _is_last_action(self):
+        # Once the response has fully streamed, the queue holds everything that is left;
+        # a queued "complete" also ends the batch
+        if not self.model_future.done():
+            return False
+        with self.action_queue.mutex:
+            return all(
+                item is None or isinstance(item, Exception)
+                or str(item.get("action_type", "")).lower() == "complete"
+                for item in self.action_queue.queue
+            )
 
+    def _execute_action(self, action_type, action_element_id, value, speculate=False):
+        # Returns the pixel box of the target element, or None for keybinds
+        if action_type in pointer_action_types:
+            # Pixel box (x0, y0, x1, y1) and its centre, precomputed by the element table
+            target = self.elements.box(action_element_id)
+            x_center, y_center = self.elements.center(action_element_id)
+
+            print(f"Action: {action_type}, Element ID: {action_element_id}, Value: {value}")
+            print(f"Coordinates: {target[0]}, {target[1]}, {target[2]}, {target[3]}")
+            print(f"Center Coordinates: {x_center}, {y_center}")
+            hit = self.elements.at(x_center, y_center)
+            if hit is not None and hit != action_element_id:
+                self.event_log.add_event("ACTION", f"Centre of element {action_element_id} lies on nested element {hit}")
+            return self._perform_action(action_type, target, (x_center, y_center), value, speculate)
+        return self._perform_action(action_type, None, None, value, speculate)
+
+    def _perform_action(self, action_type, target, center, value, speculate=False):
+        # Acts on a pixel box and its centre, or on the keyboard when there is no target
+        if target is not None:
+            # Element boxes are relative to the captured area
+            x_center, y_center = center[0] + self.capture_origin[0], center[1] + self.capture_origin[1]
+
+            # Our window only needs to get out of the way if it covers the target
+            hide = capture_hide_app or self.point_in_app(x_center, y_center)
+            if hide:
                 self.hide_app()
-                if action_type == "click":
-                    self._perform_click(x_center, y_center)
-                elif action_type == "right_click":
-                    self._perform_right_click(x_center, y_center)
-                elif action_type == "type":
-                    self._perform_type(x_center, y_center, value)
-                elif action_type == "scroll":
-                    self._perform_scroll(x_center, y_center)
-                else:
-                    raise ValueError(f"Unknown action type: {action_type}")
+            action_start = time.perf_counter()
+            if action_type == "click":
+                self._perform_click(x_center, y_center)
+            elif action_type == "right_click":
+                self._perform_right_click(x_center, y_center)
+            elif action_type == "type":
+                self._perform_type(x_center, y_center, value)
+            elif action_type == "scroll":
+                self._perform_scroll(x_center, y_center)
+            self.step_metrics.add("action", time.perf_counter() - action_start)
+            self._wait_for_settle(action_type, speculate)
+            if hide:
                 self.show_app()
 
-            elif action_type == "keybind":
-                self.hide_app()
-                self._perform_keybind(value)
-                self.show_app()
+            return target
 
-            else:
-                raise ValueError(f"Unknown or unhandled action type: {action_type}")
+        if capture_hide_app:
+            self.hide_app()
+        with self.step_metrics.span("action"):
+            self._perform_keybind(value)
+        self._wait_for_settle(action_type, speculate)
+        if capture_hide_app:
+            self.show_app()
+        return None
+
+    def _unexpected_change(self, before, after, target):
+        # Changes confined to the acted-on element (rounded up to diff tiles) are expected
+        regions = changed_regions(before, after, (self.image_width, self.image_height))
+        if regions is None:
+            return True
+        if target is None:
+            return bool(regions)
+        margin = max(self.image_width / diff_grid[0], self.image_height / diff_grid[1]) + diff_region_padding
+        x0, y0, x1, y1 = target[0] - margin, target[1] - margin, target[2] + margin, target[3] + margin
+        return any(not (rx0 >= x0 and ry0 >= y0 and rx1 <= x1 and ry1 <= y1) for rx0, ry0, rx1, ry1 in regions)
+
+    def _handle_ai_response(self):
+        # Consumer side of the step; returns whether the job should take another step
+        try:
+            action = self._first_action()
+        except Exception as e:
+            self._handle_ai_error(str(e))
+            return False
+        self._set_status("Executing action...")
 
-            self.event_log.add_event("ACTION", f"Executed {action_type} action.")
-            self._update_event_log()
-            self.status_label.text = "Action executed"
+        executed = []
+        executed_actions = []
+        try:
+            # Actions arrive from the response stream as they are parsed and validated
+            before = self.diff_frame
+            index = 0
+
+            while action is not None:
+                reasoning = action.get("reasoning", "")
+                action_type = str(action.get("action_type", "")).lower()
+                action_element_id = str(action.get("action_element_id", "") or "")
+                value = action.get("value", "")
+                changes_screen = action.get("changes_screen") in (True, "true", "True")
+
+                # Log the action
+                self.event_log.add_event("AI", f"Action {index + 1} to perform: {action_type}")
+                if action_element_id:
+                    self.event_log.add_event("AI", f"On element ID: {action_element_id}")
+                self.event_log.add_event("AI", f"Reasoning: {reasoning}")
+                self._update_event_log()
+
+                # Check for completion
+                if action_type == "complete" and executed:
+                    # Completion has to be confirmed on a screen the model has seen
+                    self.event_log.add_event("ACTION", "Completion claimed after other actions, re-capturing to confirm it")
+                    self._update_event_log()
+                    action_type = executed_actions[-1]["action_type"]
+                    break
+                if action_type == "complete":
+                    self.event_log.add_event("JOB", "User objective completed.")
+                    self._update_event_log()
+                    self.chat_context.record_outcome("; ".join(executed + ["complete"]))
+                    executed_actions.append({"action_type": "complete", "reasoning": reasoning, "description": "complete"})
+                    self._store_trajectory(executed_actions)
+                    self._set_status("Objective completed.")
+                    self._finish_step("complete")
+                    return False  # Exit the loop
+
+                # The next step starts from this action's screen if nothing else follows. Whether
+                # anything does is only known once the stream has closed, so it is decided when
+                # the screen goes quiet.
+                speculate = True if changes_screen else self._is_last_action
+                target = self._execute_action(action_type, action_element_id, value, speculate)
+                executed.append(self._describe_action(action_type, action_element_id, value))
+                executed_actions.append(self._trajectory_action(action, action_type, action_element_id, executed[-1]))
+                self.event_log.add_event("ACTION", f"Executed {action_type} action.")
+                self._update_event_log()
+
+                next_action = self._next_action()
+                if next_action is None:
+                    break
+                if changes_screen:
+                    self.event_log.add_event("ACTION", "Screen-changing action, re-capturing before the remaining actions")
+                    break
+                after = diff_frame(self._grab_screen(self.capture_rect))
+                if self._unexpected_change(before, after, target):
+                    self.event_log.add_event("ACTION", "Unexpected screen change, re-capturing before the remaining actions")
+                    break
+                before = after
+                action = next_action
+                index += 1
+
+            if not executed:
+                raise ValueError("No valid action to execute")
+            self.chat_context.record_outcome("; ".join(executed) + " -> executed")
+            self._store_trajectory(executed_actions)
+            self.step_metrics.count("actions", len(executed))
+            self._set_status("Action executed")
+            self._finish_step(action_type)
 
             # Continue the loop
-            Clock.schedule_once(lambda dt: self.take_screenshot(), 0.5)
+            return True
 
         except Exception as e:
             error_message = f"Error executing action: {str(e)}"
+            self.chat_context.record_outcome("; ".join(executed + [f"failed: {e}"]))
             self.event_log.add_event("ERROR", error_message)
             self._update_event_log()
-            self.status_label.text = error_message
-            self.processing = False
+            self._set_status(error_message)
+            self._finish_step("action_error")
+            return False
 
     def _handle_ai_error(self, error_message):
         self.event_log.add_event("ERROR", f"AI error: {error_message}")
         self._update_event_log()
-        self.status_label.text = f"AI Error: {error_message}"
-        self.processing = False
+        self._set_status(f"AI Error: {error_message}")
+        self._finish_step("ai_error")
+
+    def _settle_frame(self):
+        return screen_fingerprint(self._grab_screen(self.capture_rect), settle_frame_size)
+
+    def _wait_for_settle(self, action_type, speculate=False):
+        # speculate: whether the next step starts from this screen, or a callable deciding it
+        on_stable = None
+        if speculate and speculative_capture:
+            def on_stable(frame):
+                # Not known yet while the response is still streaming; asked again next sample
+                if callable(speculate) and not speculate():
+                    return False
+                self._start_speculation(frame)
+        waited, settled, self.settled_frame = wait_for_settle(
+            self._settle_frame,
+            sleep=self.scheduler.sleep,
+            on_stable=on_stable
+        )
+        self.step_metrics.add("settle", waited)
+        if settled:
+            self.event_log.add_event("ACTION", f"Screen settled {waited:.2f}s after {action_type}")
+        else:
+            self.event_log.add_event("ACTION", f"Screen still changing {waited:.2f}s after {action_type}, continuing")
+        self._update_event_log()
 
     def _perform_click(self, x, y):
         pyautogui.moveTo(x, y)
         pyautogui.click()
-        time.sleep(2)
 
     def _perform_right_click(self, x, y):
         pyautogui.moveTo(x, y)
         pyautogui.click(button='right')
-        time.sleep(2)
 
     def _perform_type(self, x, y, text):
         pyautogui.moveTo(x, y)
         pyautogui.click()
-        time.sleep(0.5)
-        pyautogui.typewrite(text)
-        time.sleep(2)
+        # Let the field take focus before the first character
+        time.sleep(type_focus_delay)
+        start = time.perf_counter()
+        method = self._enter_text(text)
+        seconds = time.perf_counter() - start
+        self.step_metrics.add_size("typed_chars", len(text))
+        self.event_log.add_event(
+            "ACTION",
+            f"Typed {len(text)} chars by {method} in {seconds:.2f}s "
+            f"({len(text) / seconds if seconds else 0:.0f} chars/s)"
+        )
+        self._update_event_log()
+
+    def _enter_text(self, text):
+        # typewrite only knows keys on a US layout; anything else would be dropped
+        plain = text.isascii() and all(char.isprintable() or char in "\n\t" for char in text)
+        if plain and len(text) <= type_keystroke_max_chars:
+            pyautogui.typewrite(text, interval=type_keystroke_interval)
+            return "keystrokes"
+        try:
+            self._paste_text(text)
+            return "paste"
+        except Exception as e:
+            if not plain:
+                raise
+            self.event_log.add_event("ACTION", f"Clipboard paste failed ({e}), typing instead")
+            pyautogui.typewrite(text, interval=type_keystroke_interval)
+            return "keystrokes"
+
+    def _paste_text(self, text):
+        # Only text survives the round trip; other clipboard formats are lost
+        previous = self._call_on_main(Clipboard.paste)
+        self._call_on_main(Clipboard.copy, text)
+        try:
+            pyautogui.hotkey(*paste_hotkey)
+            # The target reads the clipboard asynchronously; restore it only after that
+            time.sleep(type_paste_restore_delay)
+        finally:
+            self._call_on_main(Clipboard.copy, previous or "")
 
     def _perform_scroll(self, x, y):
         pyautogui.moveTo(x, y)
         pyautogui.scroll(-500)
-        time.sleep(2)
 
     def _perform_keybind(self, combo_str):
         if not combo_str:
@@ -553,27 +2752,171 @@ You need to think logically and efficiently. You should always consider the cont
         keys = combo_str.lower().split("+")
         keys = [k.strip() for k in keys if k.strip()]
         pyautogui.hotkey(*keys)
-        time.sleep(2)
 
     def start_job(self, instance):
-        prompt = self.user_input.text
-        if prompt.strip() == '':
+        # Queues the prompt; it starts right away unless a job is running or the queue is paused
+        prompt = self.user_input.text.strip()
+        if prompt == '':
             self.status_label.text = "Please enter a prompt."
             self.event_log.add_event("ERROR", "Empty prompt")
             self._update_event_log()
-        elif not self.processing:
-            self.event_log.add_event("JOB", f"Starting new job with prompt: {prompt}")
+            return
+        if prompt.startswith('@'):
+            self.load_objectives(prompt[1:].strip())
+        else:
+            self.queue_objective(prompt, "prompt")
+        self.user_input.text = ''
+
+    def queue_objective(self, objective, source):
+        self.job_queue.append({"objective": objective, "source": source, "queued_at": time.monotonic()})
+        if self.processing or self.paused:
+            self.event_log.add_event("JOB", f"Queued objective ({len(self.job_queue)} waiting): {objective}")
+            self._update_event_log()
+        self._start_next_job()
+
+    def load_objectives(self, path):
+        try:
+            with open(path, encoding="utf-8") as f:
+                objectives = [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+        except OSError as e:
+            self.event_log.add_event("ERROR", f"Could not read objectives from {path}: {e}")
+            self._update_event_log()
+            return
+        self.event_log.add_event("JOB", f"Queued {len(objectives)} objective(s) from {path}")
+        self._update_event_log()
+        for objective in objectives:
+            self.queue_objective(objective, path)
+
+    def _start_next_job(self, *args):
+        # Main thread only. The parser pool and model client stay warm across jobs;
+        # each job gets a fresh chat context.
+        if self.processing or self.paused or not self.job_queue:
+            return
+        job = self.job_queue.popleft()
+        self.jobs_run += 1
+        job["number"] = self.jobs_run
+        job["started_at"] = time.monotonic()
+        self.job = job
+        prompt = job["objective"]
+        waiting = f" ({len(self.job_queue)} more queued)" if self.job_queue else ""
+        self.event_log.add_event("JOB", f"Starting job {job['number']} with prompt: {prompt}{waiting}")
+        self._update_event_log()
+        self.status_label.text = f"Starting job: {prompt}"
+        self.processing = True
+        self.chat_context = ChatContext()
+        self.last_outcome = None
+        self.parser_output = None
+        self.elements = None
+        self.scope_window = None
+        self.previous_diff_frame = None
+        self.speculation = None
+        self.step_count = 0
+        self.objective = prompt
+        self.skip_trajectory = False
+        self.last_replayed = None
+        self.job_replayed = 0
+        self.job_saved = 0.0
+        self._update_app_rect()
+        # Start the loop
+        self.scheduler = StepScheduler(self._run_step)
+        self.scheduler.start(on_exit=self._on_job_exit)
+
+    def cancel_job(self, instance=None):
+        # Stops everything: the running job and the objectives queued behind it
+        if self.job_queue:
+            self.event_log.add_event("JOB", f"Dropped {len(self.job_queue)} queued objective(s)")
+            self._update_event_log()
+            self.job_queue.clear()
+        if self.processing and not self.scheduler.cancelled:
+            self.event_log.add_event("JOB", "Cancelling job...")
+            self._update_event_log()
+            self.status_label.text = "Cancelling job..."
+            self.scheduler.cancel()
+
+    def toggle_pause(self, instance=None):
+        # The running job pauses after its current step; queued jobs wait until resumed
+        self.paused = not self.paused
+        self.pause_button.text = 'Resume' if self.paused else 'Pause'
+        if self.processing:
+            if self.paused:
+                self.scheduler.pause()
+            else:
+                self.scheduler.resume()
+        if self.paused:
+            self.event_log.add_event("JOB", "Paused")
+            self.status_label.text = "Paused"
+        else:
+            self.event_log.add_event("JOB", "Resumed")
+            self.status_label.text = "Resumed"
+        self._update_event_log()
+        self._start_next_job()
+
+    def _on_job_exit(self, cancelled, error):
+        # Whatever the reporting does, the app must be free to start the next job
+        try:
+            self._report_job_exit(cancelled, error)
+        except Exception as e:
+            self.event_log.add_event("ERROR", f"Could not finish job bookkeeping: {e}")
+            self._update_event_log()
+        finally:
+            self.processing = False
+            # Back on the main thread, where jobs are started
+            Clock.schedule_once(self._start_next_job)
+
+    def _report_job_exit(self, cancelled, error):
+        self.speculation = None
+        if cancelled:
+            self._finish_step("cancelled")
+            self.event_log.add_event("JOB", "Job cancelled.")
             self._update_event_log()
-            self.status_label.text = f"Starting job: {prompt}"
-            self.processing = True
-            # Start the loop
-            Clock.schedule_once(self.take_screenshot, 0.1)
+            self._set_status("Job cancelled.")
+        elif error is not None:
+            self._finish_step("error")
+            self.event_log.add_event("ERROR", f"Job stopped: {error}")
+            self._update_event_log()
+            self._set_status(f"Error: {error}")
+        if self.trajectories is not None:
+            self.event_log.add_event(
+                "CACHE",
+                f"Trajectory cache: {self.job_replayed} of {self.step_count} step(s) replayed, "
+                f"~{self.job_saved:.1f}s of parser and model time saved ({self.trajectories.stats()})"
+            )
+        self.event_log.add_event("SCREEN", f"Screenshot store: {self.screenshots.stats()}")
+
+        job = self.job
+        if cancelled:
+            outcome = "cancelled"
+        elif error is not None:
+            outcome = "error"
+        else:
+            outcome = self.last_outcome or "stopped"
+        self.event_log.add_event(
+            "JOB",
+            f"Job {job['number']} {outcome}: {time.monotonic() - job['started_at']:.1f}s wall "
+            f"({self.scheduler.paused_seconds:.1f}s paused), {self.step_count} step(s), "
+            f"{self.job_replayed} replayed, {job['started_at'] - job['queued_at']:.1f}s queue wait"
+        )
+        self._update_event_log()
 
 
 class MyKivyApp(App):
     def build(self):
         return MyAppLayout()
 
+    def on_start(self):
+        # Runs before the first frame; measure up to it, then warm up in the background
+        Clock.schedule_once(self._after_first_frame)
+
+    def _after_first_frame(self, dt):
+        startup_mark("first frame")
+        self.root.log_startup()
+        self.root.start_warm_up()
+        if objectives_path:
+            self.root.load_objectives(objectives_path)
+
+    def on_stop(self):
+        self.root.cancel_job()
+
 
 if __name__ == '__main__':
     MyKivyApp().run()
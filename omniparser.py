@@ -0,0 +1,512 @@
+# OmniParser client shared by the app (main.py) and the headless batch mode:
+#
+#   python omniparser.py screenshots/ "more/*.png" --out parsed.jsonl --concurrency 8
+import argparse
+import ast
+import base64
+import glob
+import json
+import math
+import mimetypes
+import os
+import random
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager
+from queue import Queue, Empty
+from threading import Thread, Lock, Event
+
+# Parser endpoints, tried in order of health: rolling p50 latency weighted by error rate.
+parser_addresses = [
+    "https://microsoft-omniparser.hf.space",
+    # "https://totob12-omniparser.hf.space",
+]
+parser_health_window = 20
+parser_max_retries = 3
+# Failed requests back off exponentially with jitter (seconds)
+parser_backoff_base = 0.5
+parser_backoff_max = 8
+# Hedging: when a request runs past the endpoint's p95 latency (at least
+# parser_hedge_min_delay, parser_hedge_initial_delay before any samples),
+# the same request is also sent to the next endpoint and the first result wins.
+parser_hedging = True
+parser_hedge_min_delay = 2.0
+parser_hedge_initial_delay = 20.0
+
+# Parser HTTP client: keep-alive connection pool and per-phase timeouts (seconds).
+# parser_result_timeout bounds the whole wait on the result stream, heartbeats included.
+parser_pool_size = 4
+parser_connect_timeout = 5
+parser_read_timeout = 30
+parser_result_timeout = 180
+# How often a waiting request checks whether its caller gave up on it
+parser_cancel_poll = 0.1
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+class StageTimings:
+    # Seconds per stage of a single request, merged into the caller's metrics
+    def __init__(self):
+        self.stages = {}
+        self.counts = {}
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def count(self, name, amount=1):
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+
+def build_parser_payload(data, mime_type, name):
+    encoded_string = base64.b64encode(data).decode('utf-8')
+    return {
+        "data": [
+            {
+                "url": f"data:{mime_type};base64,{encoded_string}",
+                "size": len(data),
+                "orig_name": name,
+                "mime_type": mime_type
+            },
+            0.05,  # box_threshold
+            0.1    # iou_threshold
+        ]
+    }
+
+
+class ParserClient:
+    def __init__(self, address=None, pool_size=None):
+        self.address = (address or parser_addresses[0]).rstrip('/')
+        self.pool_size = pool_size or parser_pool_size
+        self._session = None
+        self.session_lock = Lock()
+
+    @property
+    def session(self):
+        # requests is imported with the first session (the app's warm-up or first
+        # request), so importing this module does not delay the first frame
+        with self.session_lock:
+            if self._session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._session = session
+            return self._session
+
+    def submit(self, payload):
+        post_url = self.address + '/gradio_api/call/process'
+        post_response = self.session.post(
+            post_url,
+            json=payload,
+            timeout=(parser_connect_timeout, parser_read_timeout)
+        )
+        if post_response.status_code != 200:
+            raise Exception(f"POST request failed with status code {post_response.status_code}")
+
+        event_id = post_response.json().get('event_id')
+        if not event_id:
+            raise Exception("No event_id returned from POST request")
+        return event_id
+
+    def iter_events(self, response):
+        # Server-sent events: "event:" and "data:" fields, dispatched on a blank line
+        event, data_lines = "message", []
+        for line in response.iter_lines(decode_unicode=True):
+            if line is None:
+                continue
+            if line == "":
+                if data_lines or event != "message":
+                    yield event, "\n".join(data_lines)
+                event, data_lines = "message", []
+            elif line.startswith(":"):
+                continue
+            elif line.startswith("event:"):
+                event = line[len("event:"):].strip()
+            elif line.startswith("data:"):
+                data_lines.append(line[len("data:"):].strip())
+        if data_lines:
+            yield event, "\n".join(data_lines)
+
+    def wait_result(self, event_id, metrics=None, abort=None):
+        get_url = self.address + f'/gradio_api/call/process/{event_id}'
+        started = time.perf_counter()
+        first_event_at = None
+        deadline = time.monotonic() + parser_result_timeout
+        with self.session.get(
+            get_url,
+            stream=True,
+            timeout=(parser_connect_timeout, parser_read_timeout)
+        ) as get_response:
+            if get_response.status_code != 200:
+                raise Exception(f"GET request failed with status code {get_response.status_code}")
+
+            for event, data in self.iter_events(get_response):
+                if abort is not None and abort.is_set():
+                    # Nobody waits for this result any more; drop the stream at the next event
+                    raise Exception("Parser request abandoned")
+                if first_event_at is None:
+                    first_event_at = time.perf_counter()
+                    if metrics is not None:
+                        metrics.add("parser_queue", first_event_at - started)
+                if event == "error":
+                    raise Exception(f"Parser returned an error: {data or 'no details'}")
+                if event == "complete" or (event == "message" and data):
+                    result_data = json.loads(data) if data else None
+                    if metrics is not None:
+                        metrics.add("parser_result", time.perf_counter() - first_event_at)
+                    if result_data:
+                        return result_data
+                    raise Exception("Parser completed without data")
+                # heartbeat / generating: keep waiting, but not forever
+                if time.monotonic() > deadline:
+                    raise Exception(f"No parser result after {parser_result_timeout} seconds")
+
+        raise Exception("Result stream closed before the parser completed")
+
+    def warm_up(self):
+        # Opens the keep-alive connection, TLS handshake included, ahead of the first upload
+        self.session.head(self.address, timeout=(parser_connect_timeout, parser_read_timeout))
+
+    def parse_result(self, result_data):
+        return {
+            "url": self.address + f"/gradio_api/file={result_data[0].get('path')}",
+            "text": result_data[1],
+            "coordinates": ast.literal_eval(result_data[2])
+        }
+
+
+def backoff_delay(attempt):
+    delay = min(parser_backoff_max, parser_backoff_base * 2 ** (attempt - 1))
+    return random.uniform(delay / 2, delay)
+
+
+class ParserEndpoint:
+    def __init__(self, address, pool_size=None):
+        self.client = ParserClient(address, pool_size)
+        self.address = self.client.address
+        self.latencies = deque(maxlen=parser_health_window)
+        self.outcomes = deque(maxlen=parser_health_window)
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.lock = Lock()
+
+    def record(self, ok, seconds):
+        with self.lock:
+            self.outcomes.append(ok)
+            if ok:
+                self.latencies.append(seconds)
+                self.consecutive_failures = 0
+                self.cooldown_until = 0.0
+            else:
+                self.consecutive_failures += 1
+                self.cooldown_until = time.monotonic() + backoff_delay(self.consecutive_failures)
+
+    def error_rate(self):
+        with self.lock:
+            if not self.outcomes:
+                return 0.0
+            return self.outcomes.count(False) / len(self.outcomes)
+
+    def latency(self, fraction):
+        with self.lock:
+            latencies = list(self.latencies)
+        return percentile(latencies, fraction) if latencies else None
+
+    def score(self):
+        p50 = self.latency(0.5)
+        if p50 is None:
+            # Untried endpoints go first so they get samples
+            return 0.0 if not self.outcomes else float("inf")
+        return p50 * (1 + 4 * self.error_rate())
+
+    def available(self):
+        return time.monotonic() >= self.cooldown_until
+
+    def stats(self):
+        p50, p95 = self.latency(0.5), self.latency(0.95)
+        latency = f"p50 {p50:.1f}s p95 {p95:.1f}s" if p50 is not None else "no samples"
+        return f"{self.address}: {latency}, errors {self.error_rate():.0%} of {len(self.outcomes)}"
+
+
+class ParserPool:
+    def __init__(self, addresses=None, pool_size=None):
+        self.endpoints = [ParserEndpoint(address, pool_size) for address in (addresses or parser_addresses)]
+
+    def ranked(self):
+        return sorted(self.endpoints, key=lambda endpoint: (not endpoint.available(), endpoint.score()))
+
+    def hedge_delay(self, endpoint):
+        p95 = endpoint.latency(0.95)
+        if p95 is None:
+            return parser_hedge_initial_delay
+        return max(parser_hedge_min_delay, p95)
+
+    def _attempt(self, endpoint, payload, results, abort):
+        attempt_metrics = StageTimings()
+        start = time.perf_counter()
+        try:
+            with attempt_metrics.span("parser_post"):
+                event_id = endpoint.client.submit(payload)
+            result_data = endpoint.client.wait_result(event_id, attempt_metrics, abort)
+            output = endpoint.client.parse_result(result_data)
+            endpoint.record(True, time.perf_counter() - start)
+            results.put((endpoint, event_id, output, attempt_metrics, None))
+        except Exception as e:
+            # An abandoned request says nothing about the endpoint's health
+            if not abort.is_set():
+                endpoint.record(False, time.perf_counter() - start)
+            results.put((endpoint, None, None, attempt_metrics, e))
+
+    def _start(self, endpoint, payload, results, abort):
+        Thread(target=self._attempt, args=(endpoint, payload, results, abort), daemon=True).start()
+
+    def request(self, payload, metrics=None, check=None):
+        # Returns (output, endpoint, event_id) from the first attempt that succeeds.
+        # check() is called while waiting; when it raises, the request is abandoned
+        # and its attempts stop reading their result streams.
+        ranked = self.ranked()
+        results = Queue()
+        abort = Event()
+        self._start(ranked[0], payload, results, abort)
+        pending, hedged = 1, False
+        hedge_at = time.monotonic() + self.hedge_delay(ranked[0])
+        error = None
+        try:
+            while pending:
+                can_hedge = parser_hedging and not hedged and len(ranked) > 1
+                timeout = max(0.0, hedge_at - time.monotonic()) if can_hedge else None
+                if check is not None:
+                    check()
+                    timeout = parser_cancel_poll if timeout is None else min(timeout, parser_cancel_poll)
+                try:
+                    endpoint, event_id, output, attempt_metrics, attempt_error = results.get(timeout=timeout)
+                except Empty:
+                    if not can_hedge or time.monotonic() < hedge_at:
+                        continue
+                    # Primary is slower than usual; race the next endpoint against it
+                    hedged = True
+                    pending += 1
+                    self._start(ranked[1], payload, results, abort)
+                    if metrics is not None:
+                        metrics.count("parser_hedge")
+                    continue
+
+                pending -= 1
+                if attempt_error is None:
+                    if metrics is not None:
+                        for stage, seconds in attempt_metrics.stages.items():
+                            metrics.add(stage, seconds)
+                    return output, endpoint, event_id
+                error = attempt_error
+            raise error
+        finally:
+            # Whether won, failed or abandoned, attempts still running (a hedge's loser)
+            # drop their result streams at the next event and free their queue slots
+            abort.set()
+
+    def warm_up(self):
+        for endpoint in self.endpoints:
+            endpoint.client.warm_up()
+
+    def stats(self):
+        return " | ".join(endpoint.stats() for endpoint in self.endpoints)
+
+
+image_extensions = (".png", ".jpg", ".jpeg", ".webp", ".bmp", ".gif")
+
+
+def find_images(patterns):
+    # Directories are searched recursively, anything else is expanded as a glob
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, _, names in os.walk(pattern):
+                paths.update(
+                    os.path.normpath(os.path.join(root, name))
+                    for name in names if name.lower().endswith(image_extensions)
+                )
+        else:
+            paths.update(os.path.normpath(path) for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+    return sorted(paths)
+
+
+def load_completed(path):
+    # Images that already have a result in the output; failed ones are tried again
+    completed = set()
+    if not os.path.exists(path):
+        return completed
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # cut off by an interrupted run
+            if "error" not in record:
+                completed.add(record["image"])
+    return completed
+
+
+class BatchInterrupted(BaseException):
+    # Raised in batch workers once the run is interrupted; unlike parser errors, not retried
+    pass
+
+
+def parse_file(pool, path, retries, interrupted=None):
+    with open(path, "rb") as f:
+        data = f.read()
+    mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    # Uploaded as stored; the files are already encoded images
+    payload = build_parser_payload(data, mime_type, os.path.basename(path))
+    interrupted = interrupted or Event()
+
+    def check():
+        if interrupted.is_set():
+            raise BatchInterrupted()
+
+    start = time.perf_counter()
+    attempt = 1
+    while True:
+        try:
+            output, endpoint, event_id = pool.request(payload, StageTimings(), check)
+            break
+        except Exception:
+            if attempt >= retries:
+                raise
+            interrupted.wait(backoff_delay(attempt))
+            check()
+            attempt += 1
+    return {
+        "image": path,
+        "text": output["text"],
+        "coordinates": output["coordinates"],
+        "endpoint": endpoint.address,
+        "attempts": attempt,
+        "seconds": round(time.perf_counter() - start, 3),
+        "bytes": len(data),
+    }
+
+
+def run_batch(paths, out_path, concurrency, retries, pool=None, progress_interval=5.0):
+    # Keeps at most `concurrency` images in flight and appends one JSON line per image
+    # as it finishes. Returns (parsed, failed, seconds, latencies, uploaded bytes).
+    pool = pool or ParserPool(pool_size=concurrency)
+    completed = load_completed(out_path)
+    pending = [path for path in paths if path not in completed]
+    if completed:
+        print(f"Resuming: {len(paths) - len(pending)} of {len(paths)} images already parsed", file=sys.stderr)
+
+    parsed = failed = uploaded = 0
+    latencies = []
+    started = last_report = time.perf_counter()
+    queued = iter(pending)
+    running = {}
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="parse")
+    # Set on the way out, so in-flight requests are abandoned instead of awaited
+    interrupted = Event()
+
+    def submit_next():
+        path = next(queued, None)
+        if path is not None:
+            running[executor.submit(parse_file, pool, path, retries, interrupted)] = path
+
+    with open(out_path, "a+", encoding="utf-8") as out:
+        # An interrupted run may have left a partial last line
+        if out.tell():
+            out.seek(out.tell() - 1)
+            if out.read(1) != "\n":
+                out.write("\n")
+        try:
+            for _ in range(concurrency):
+                submit_next()
+            while running:
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    path = running.pop(future)
+                    try:
+                        record = future.result()
+                        parsed += 1
+                        uploaded += record["bytes"]
+                        latencies.append(record["seconds"])
+                    except Exception as e:
+                        record = {"image": path, "error": str(e)}
+                        failed += 1
+                    out.write(json.dumps(record) + "\n")
+                    out.flush()
+                    submit_next()
+
+                now = time.perf_counter()
+                if now - last_report >= progress_interval:
+                    last_report = now
+                    print(
+                        f"{parsed + failed}/{len(pending)} images, "
+                        f"{(parsed + failed) / (now - started):.2f} images/s, {failed} failed",
+                        file=sys.stderr
+                    )
+        finally:
+            interrupted.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    return parsed, failed, time.perf_counter() - started, latencies, uploaded
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description="Parse a corpus of screenshots with OmniParser into JSONL.")
+    argument_parser.add_argument("inputs", nargs="+", help="image directories or glob patterns")
+    argument_parser.add_argument("--out", required=True, help="JSONL file to append results to; rerun to resume")
+    argument_parser.add_argument("--concurrency", type=int, default=parser_pool_size, help="images in flight at once")
+    argument_parser.add_argument("--retries", type=int, default=parser_max_retries, help="attempts per image")
+    argument_parser.add_argument(
+        "--address",
+        action="append",
+        help="parser endpoint (repeatable); defaults to parser_addresses"
+    )
+    args = argument_parser.parse_args()
+    if args.concurrency < 1:
+        argument_parser.error("--concurrency must be at least 1")
+
+    paths = find_images(args.inputs)
+    if not paths:
+        argument_parser.error("No images found")
+
+    pool = ParserPool(args.address, pool_size=args.concurrency)
+    try:
+        parsed, failed, seconds, latencies, uploaded = run_batch(
+            paths, args.out, args.concurrency, args.retries, pool
+        )
+    except KeyboardInterrupt:
+        print(f"Interrupted; run again with --out {args.out} to resume", file=sys.stderr)
+        sys.exit(130)
+
+    total = parsed + failed
+    print(
+        f"{total} images in {seconds:.1f}s: {total / seconds if seconds else 0:.2f} images/s, "
+        f"{uploaded / seconds / 1e6 if seconds else 0:.2f} MB/s uploaded, {failed} failed"
+    )
+    if latencies:
+        print(f"per image: p50 {percentile(latencies, 0.5):.2f}s p95 {percentile(latencies, 0.95):.2f}s")
+    print(f"endpoints: {pool.stats()}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("API_KEY", "test")
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+os.environ.setdefault("KIVY_NO_CONSOLELOG", "1")
+if not os.environ.get("DISPLAY") and sys.platform.startswith("linux"):
+    os.environ.setdefault("SDL_VIDEODRIVER", "offscreen")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+import omniparser  # noqa: E402
+
+
+def table(text, count):
+    coordinates = {str(i): [0.1 * i, 0.1, 0.05, 0.05] for i in range(count)}
+    return main.ElementTable({"text": text, "coordinates": coordinates}, (1920, 1080))
+
+
+def test_empty_label_only_drops_that_element():
+    elements = table("Text Box ID 0: File\nText Box ID 1: \nIcon Box ID 2: Save button", 3)
+    text, listed = main.compact_element_list(elements, min_size=4, drop_unlabeled=True)
+    assert listed == 2
+    assert "0: File" in text
+    assert "2: Save button" in text
+
+
+def test_wrapped_label_continues_previous_element():
+    elements = table("Text Box ID 0: Open a\nrecent file\nIcon Box ID 1: gear", 2)
+    assert elements.label("0") == "Open a recent file"
+    assert elements.label("1") == "gear"
+
+
+def test_icon_dict_format():
+    elements = table("icon 0: {'type': 'text', 'content': 'File'}\nicon 1: {'type': 'icon', 'content': 'Gear'}", 2)
+    text, listed = main.compact_element_list(elements, min_size=4, drop_unlabeled=True)
+    assert listed == 2
+    assert "0: File" in text and "1: Gear" in text
+
+
+def test_unknown_labels_are_kept():
+    elements = table("Text Box ID 0: File", 2)
+    text, listed = main.compact_element_list(elements, min_size=4, drop_unlabeled=True)
+    assert listed == 2
+    assert "1: (no label)" in text
+
+
+def test_unreadable_text_is_sent_as_is():
+    raw = "something else entirely"
+    text, listed = main.compact_element_list(table(raw, 2), min_size=4, drop_unlabeled=True)
+    assert text == raw
+    assert listed == 2
+
+
+def test_strict_parse_rejects_unknown_lines():
+    assert main.parse_element_lines("Text Box ID 0: File\nnot an element") is None
+
+
+def test_stream_parser_yields_actions_split_across_chunks():
+    response = '[{"action_type": "type", "value": "a \\"}{\\" b"}, {"action_type": "complete"}]'
+    parser = main.ActionStreamParser()
+    actions = []
+    for start in range(0, len(response), 3):
+        actions.extend(parser.feed(response[start:start + 3]))
+    assert actions == [{"action_type": "type", "value": 'a "}{" b'}, {"action_type": "complete"}]
+
+
+def test_stream_parser_yields_an_action_before_the_rest_arrives():
+    parser = main.ActionStreamParser()
+    assert parser.feed('[{"action_type": "click", "value": "{"}') == [{"action_type": "click", "value": "{"}]
+    assert parser.feed(', {"action_type"') == []
+
+
+def test_region_merge_keeps_ids_of_unchanged_elements():
+    previous = {
+        "text": "Text Box ID 0: File\nText Box ID 1: Edit",
+        "coordinates": {"0": [0.1, 0.1, 0.1, 0.1], "1": [0.6, 0.6, 0.1, 0.1]},
+    }
+    # The region (500, 500)-(800, 800) is re-parsed: "Edit" is found again, plus a new element
+    region = {
+        "text": "Text Box ID 0: Edit\nText Box ID 1: New",
+        "coordinates": {"0": [1 / 3, 1 / 3, 1 / 3, 1 / 3], "1": [0.0, 0.0, 0.1, 0.1]},
+    }
+    merged = main.merge_region_outputs(previous, [((500, 500, 800, 800), region)], (1000, 1000))
+    assert merged["text"].splitlines() == ["Text Box ID 0: File", "Text Box ID 1: Edit", "Text Box ID 2: New"]
+    assert merged["coordinates"]["0"] == [0.1, 0.1, 0.1, 0.1]
+    assert merged["coordinates"]["1"] == pytest.approx([0.6, 0.6, 0.1, 0.1])
+    assert merged["coordinates"]["2"] == pytest.approx([0.5, 0.5, 0.03, 0.03])
+
+
+class FakeStream:
+    def __init__(self, lines, status_code=200):
+        self.lines = lines
+        self.status_code = status_code
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def iter_lines(self, decode_unicode=False):
+        return iter(self.lines)
+
+
+class FakeSession:
+    def __init__(self, lines):
+        self.lines = lines
+
+    def get(self, url, **kwargs):
+        return FakeStream(self.lines)
+
+
+def test_sse_events_skip_comments_and_join_data_lines():
+    lines = [": ping", "event: heartbeat", "data: null", "", "event: complete", "data: [1,", "data: 2]", ""]
+    events = list(omniparser.ParserClient("http://parser").iter_events(FakeStream(lines)))
+    assert events == [("heartbeat", "null"), ("complete", "[1,\n2]")]
+
+
+def parser_client(lines):
+    client = omniparser.ParserClient("http://parser")
+    client._session = FakeSession(lines)
+    return client
+
+
+def test_sse_result_after_heartbeats():
+    lines = ["event: heartbeat", "data: null", "", "event: complete", 'data: ["image", "text"]', ""]
+    assert parser_client(lines).wait_result("1") == ["image", "text"]
+
+
+def test_sse_error_event_raises():
+    lines = ["event: heartbeat", "data: null", "", "event: error", "data: GPU quota exceeded", ""]
+    with pytest.raises(Exception, match="GPU quota exceeded"):
+        parser_client(lines).wait_result("1")
+
+
+def test_sse_stream_closed_without_result_raises():
+    with pytest.raises(Exception, match="closed before"):
+        parser_client(["event: heartbeat", "data: null", ""]).wait_result("1")